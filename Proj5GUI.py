@@ -6,6 +6,7 @@ import signal
 import sys
 import time
 
+import numpy as np
 
 from which_pyqt import PYQT_VER
 if PYQT_VER == 'PYQT5':
@@ -37,28 +38,37 @@ class PointLineView( QWidget ):
 		self.pointList	= {}
 		self.edgeList	= {}
 		self.labelList	 = {}
+		self.edgeLabelList = {}
 		self.status_bar = status_bar
 		self.data_range = data_range
 		self.start_pt = None
 		self.end_pt = None
+		self._geometry = None		# scaled edges and edge labels, rebuilt after any change (see _sceneGeometry)
+		self._background = None		# points and other labels, drawn once (see _backgroundPixmap)
 
 	def displayStatusText(self, text):
 		self.status_bar.showMessage(text)
 
 	def clearPoints(self):
 		self.pointList = {}
+		self._background = None
 
 	def clearEdges(self,removeColors = None):
 		self.edgeList = {}
+		self.edgeLabelList = {}						# an edge's label always goes with it
+		self._geometry = None
 		if removeColors:							# allows removal of edge labels without removing node labels, for example
 			for color in removeColors:
 				if color in self.labelList:
 					del self.labelList[color]			
+					self._background = None
 		else:
 			self.labelList = {}
+			self._background = None
 		self.repaint()
 
 	def addPoints( self, point_list, color ):
+		self._background = None
 		if color in self.pointList:
 			self.pointList[color].extend( point_list )
 		else:
@@ -82,6 +92,7 @@ class PointLineView( QWidget ):
 		assert( type(label)	  == str )
 
 		edge = QLineF(startPt, endPt)
+		self._geometry = None
 		if edgeColor in self.edgeList.keys():
 			self.edgeList[edgeColor].append( edge )
 		else:
@@ -89,9 +100,13 @@ class PointLineView( QWidget ):
 
 		midp = QPointF( (edge.x1()*0.2 + edge.x2()*0.8), 
 						(edge.y1()*0.2 + edge.y2()*0.8) )
-		self.addLabel( midp, label, labelColor, xoffset=xoffset )
+		if labelColor in self.edgeLabelList.keys():
+			self.edgeLabelList[labelColor].append( (midp,label,xoffset) )
+		else:
+			self.edgeLabelList[labelColor] = [(midp,label,xoffset)]
 
 	def addLabel( self, point, label, labelColor,xoffset=0.0 ):
+		self._background = None
 		if labelColor in self.labelList.keys():
 			self.labelList[labelColor].append( (point,label,xoffset) )
 		else:
@@ -100,96 +115,177 @@ class PointLineView( QWidget ):
 
 
 
-	def paintEvent(self, event):
-		painter = QPainter(self)
-		painter.setRenderHint(QPainter.Antialiasing,True)
+	def resizeEvent(self, event):
+		self._geometry = None
+		self._background = None
+		super(PointLineView,self).resizeEvent(event)
+
+	ARROW_SIZE = 5.0	# pixels
+	CITY_SIZE = 2.0		# pixels (radius)
+	LABEL_RECT = 1.0E3	# half-size of the box each label is centered in
+
+	# Level of detail: when a color has more labels than would fit one per
+	# LABEL_SPACING x LABEL_SPACING pixel square, only the first label in each
+	# such square is drawn
+	LABEL_SPACING = 40
 
+	def _scale(self):
 		xr = self.data_range['x']
 		yr = self.data_range['y']
 		w = self.width()
 		h = self.height()
 		w2h_desired_ratio = (xr[1]-xr[0])/(yr[1]-yr[0])
 		if w / h < w2h_desired_ratio:
-			 scale = w / (xr[1]-xr[0])
+			 return w / (xr[1]-xr[0])
 		else:
-			 scale = h / (yr[1]-yr[0])
+			 return h / (yr[1]-yr[0])
 
+	def _transform(self):
+		''' Data coordinates times _scale() to widget pixels: the origin at the
+			center and y pointing up. '''
 		tform = QTransform()
 		tform.translate(self.width()/2.0,self.height()/2.0)
 		tform.scale(1.0,-1.0)
-		painter.setTransform(tform)
+		return tform
 
-		for color in self.edgeList:
+	def _labelBoxes(self, label_list, scale):
+		''' {color: [(box in widget coordinates, text)]} for the labels in
+			label_list that are drawn at this size. '''
+		w = self.width()
+		h = self.height()
+		R = self.LABEL_RECT
+		S = self.LABEL_SPACING
+		boxes = {}
+		for color in label_list:
+			labels = label_list[color]
+			at = np.array( [(pt.x(), pt.y(), xoff) for pt, text, xoff in labels], dtype=np.float64 ).reshape(-1, 3)
+			x = w/2.0 + scale*at[:,0] + at[:,2]
+			y = h/2.0 - scale*at[:,1]
+			shown = range(len(labels))
+			if len(labels) * S * S > w * h:
+				cells = np.column_stack( (np.floor(x/S), np.floor(y/S)) )
+				shown = np.sort( np.unique(cells, axis=0, return_index=True)[1] ).tolist()
+			boxes[color] = [ (QRectF(x[i] - R, y[i] - R, 2.0*R, 2.0*R), labels[i][1]) for i in shown ]
+		return boxes
+
+	def _drawLabels(self, painter, boxes):
+		align = QTextOption( Qt.Alignment(Qt.AlignHCenter | Qt.AlignVCenter) )
+		for color in boxes:
 			c = QColor(color[0],color[1],color[2])
 			painter.setPen( c )
-			for edge in self.edgeList[color]:
-				ln = QLineF( scale*edge.x1(), scale*edge.y1(), scale*edge.x2(), scale*edge.y2() )
-				painter.drawLine( ln )
-
+			for rect, text in boxes[color]:
+				painter.drawText( rect, text, align )
+
+	def _sceneGeometry(self):
+		''' The edges, already scaled to the widget: per color, one list of lines
+			and their arrowheads as polygons, plus the edge label boxes.  Kept until
+			the edges or the widget's size change. '''
+		if self._geometry is not None:
+			return self._geometry
+
+		scale = self._scale()
+		edges = {}
 		for color in self.edgeList:
+			ends = scale * np.array( [(e.x1(), e.y1(), e.x2(), e.y2()) for e in self.edgeList[color]],
+									 dtype=np.float64 ).reshape(-1, 4)
+			lines = [ QLineF(*end) for end in ends.tolist() ]
+			direction = ends[:,2:] - ends[:,:2]
+			length = np.hypot( direction[:,0], direction[:,1] )
+			drawn = length > 0
+			unit = direction[drawn] / length[drawn,None]
+			perp = np.column_stack( (-unit[:,1], unit[:,0]) )
+			tips = ends[drawn,2:]
+			corners = np.hstack( (tips, tips - self.ARROW_SIZE*(2*unit + perp), tips - self.ARROW_SIZE*(2*unit - perp)) )
+			# One polygon per arrowhead: filling a single path of thousands of
+			# triangles is several times slower with antialiasing on
+			arrows = [ QPolygonF([QPointF(tx,ty), QPointF(ax,ay), QPointF(bx,by)])
+					   for tx, ty, ax, ay, bx, by in corners.tolist() ]
+			edges[color] = (lines, arrows)
+
+		self._geometry = (edges, self._labelBoxes(self.edgeLabelList, scale))
+		return self._geometry
+
+	def _backgroundPixmap(self):
+		''' The points and the labels not tied to an edge, which rarely change
+			between repaints, drawn on a transparent pixmap the widget's size. '''
+		if self._background is not None:
+			return self._background
+
+		ratio = self.devicePixelRatioF() if PYQT_VER == 'PYQT5' else 1.0
+		pixmap = QPixmap( int(math.ceil(self.width()*ratio)), int(math.ceil(self.height()*ratio)) )
+		if PYQT_VER == 'PYQT5':
+			pixmap.setDevicePixelRatio( ratio )
+		pixmap.fill( Qt.transparent )
+
+		scale = self._scale()
+		painter = QPainter(pixmap)
+		painter.setRenderHint(QPainter.Antialiasing,True)
+		painter.setFont( self.font() )
+		self._drawLabels( painter, self._labelBoxes(self.labelList, scale) )
+
+		painter.setTransform(self._transform())
+		for color in self.pointList:
 			c = QColor(color[0],color[1],color[2])
 			painter.setPen( c )
-			for edge in self.edgeList[color]:
-				#arrow_scale = .015
-				arrow_scale = 5.0
-				unit_edge = ( edge.x2() - edge.x1(), edge.y2() - edge.y1() )
-				unit_edge_mag = math.sqrt( ( edge.x2() - edge.x1())**2 + ( edge.y2() - edge.y1() )**2 )
-				unit_edge = (unit_edge[0] / unit_edge_mag, unit_edge[1] / unit_edge_mag )
-				unit_edge_perp = (-unit_edge[1], unit_edge[0])
-
-				temp_tform = QTransform()
-				temp_tform.translate(self.width()/2.0,self.height()/2.0)
-				temp_tform.scale(1.0,-1.0)
-				temp_tform.translate(scale*edge.x2(),scale*edge.y2())
-				temp_tform.scale(1.0,-1.0)
-				painter.setTransform(temp_tform)
-				#painter.drawText( RECT, label[1], align )
-
-				tri_pts = []
-				tri_pts.append( QPointF(0,0) )
-				tri_pts.append( QPointF(-arrow_scale*(2*unit_edge[0] + unit_edge_perp[0]),
-										arrow_scale*(2*unit_edge[1] + unit_edge_perp[1])) )
-				tri_pts.append( QPointF(-arrow_scale*(2*unit_edge[0] - unit_edge_perp[0]),
-										arrow_scale*(2*unit_edge[1] - unit_edge_perp[1])) )
-				tri = QPolygonF( tri_pts )
-				b = painter.brush()
-				painter.setBrush( c )
-				painter.drawPolygon( tri )
-				painter.setBrush( b )
-
-		painter.setTransform(tform)
-		font = QFont("Monospace")
-		font.setStyleHint(QFont.TypeWriter)
-
-		R = 1.0E3
-		CITY_SIZE = 2.0 # DIAMETER
-		RECT = QRectF(-R,-R,2.0*R,2.0*R)
-		align = QTextOption( Qt.Alignment(Qt.AlignHCenter | Qt.AlignVCenter) )
-		for color in self.labelList:
-			c = QColor(color[0],color[1],color[2])
-			painter.setPen( c )
-			for label in self.labelList[color]:
-				temp_tform = QTransform()
-				temp_tform.translate(self.width()/2.0,self.height()/2.0)
-				temp_tform.scale(1.0,-1.0)
-				pt = label[0]
-				xoff = label[2]
-				temp_tform.translate(scale*pt.x()+xoff,scale*pt.y())
-				temp_tform.scale(1.0,-1.0)
-				painter.setTransform(temp_tform)
-				painter.drawText( RECT, label[1], align )
-
-		painter.setTransform(tform)
-		for color in self.pointList:
+			painter.setBrush( c )
+			for point in self.pointList[color]:
+				painter.drawEllipse( QPointF(scale*point.x(), scale*point.y()), self.CITY_SIZE, self.CITY_SIZE)
+		painter.end()
+
+		self._background = pixmap
+		return self._background
+
+	def paintEvent(self, event):
+		painter = QPainter(self)
+		painter.setRenderHint(QPainter.Antialiasing,True)
+		edges, edge_labels = self._sceneGeometry()
+
+		painter.setTransform(self._transform())
+		for color in edges:
 			c = QColor(color[0],color[1],color[2])
+			lines, arrows = edges[color]
 			painter.setPen( c )
+			painter.drawLines( lines )
 			b = painter.brush()
-			painter.setBrush(c)
-			for point in self.pointList[color]:
-				pt = QPointF(scale*point.x(), scale*point.y())
-				painter.drawEllipse( pt, CITY_SIZE, CITY_SIZE)
-			painter.setBrush(b)
+			painter.setBrush( c )
+			for arrow in arrows:
+				painter.drawPolygon( arrow )
+			painter.setBrush( b )
+
+		painter.resetTransform()
+		self._drawLabels( painter, edge_labels )
+
+		# Cities and their labels go on top of the tour, as they always have
+		painter.drawPixmap( 0, 0, self._backgroundPixmap() )
+
+
 
+class SolverThread( QThread, SolverListener ):
+	''' Runs one TSPSolver method off the GUI thread.  progress carries the
+		solver's on_new_bssf and on_stats results dictionaries and done the final
+		one; both are delivered to the GUI thread through queued signal connections. '''
+	progress = pyqtSignal(object)
+	done	 = pyqtSignal(object)
+
+	def __init__( self, solver, algorithm, time_allowance ):
+		super(SolverThread,self).__init__()
+		self.solver = solver
+		self.algorithm = algorithm
+		self.time_allowance = time_allowance
+
+	def on_new_bssf( self, results ):
+		self.progress.emit( results )
+
+	def on_stats( self, results ):
+		self.progress.emit( results )
+
+	def run( self ):
+		self.solver.addListener( self )
+		try:
+			results = getattr( self.solver, self.algorithm )( time_allowance=self.time_allowance )
+		finally:
+			self.solver.removeListener( self )
+		self.done.emit( results )
 
 
 class Proj5GUI( QMainWindow ):
@@ -202,6 +298,7 @@ class Proj5GUI( QMainWindow ):
 		self._MAX_SEED = 1000 
 
 		self._scenario = None
+		self.solverThread = None
 		self.initUI()
 		self.solver = TSPSolver( self.view )
 		self.genParams = {'size':None,'seed':None,'diff':None}
@@ -211,21 +308,8 @@ class Proj5GUI( QMainWindow ):
 	def newPoints(self):		
 		# TODO - ERROR CHECKING!!!!
 		seed = int(self.curSeed.text())
-		random.seed( seed )
-
-		ptlist = []
-		RANGE = self.data_range
-		xr = self.data_range['x']
-		yr = self.data_range['y']
 		npoints = int(self.size.text())
-		while len(ptlist) < npoints:
-			x = random.uniform(0.0,1.0)
-			y = random.uniform(0.0,1.0)
-			if True:
-				xval = xr[0] + (xr[1]-xr[0])*x
-				yval = yr[0] + (yr[1]-yr[0])*y
-				ptlist.append( QPointF(xval,yval) )
-		return ptlist
+		return generatePoints( npoints, seed, self.data_range )
 
 	def generateNetwork(self):
 		points = self.newPoints() # uses current rand seed
@@ -267,7 +351,6 @@ class Proj5GUI( QMainWindow ):
 	def displaySolution( self ) :						# what about calling this somehow every time a new bssf is found?
 		self.view.clearEdges([(64,64,255)])				# get rid of edge labels but not point labels
 		if self._solution:
-			self.addCities()
 			edges = self._solution.enumerateEdges()
 			if edges:
 				edgeColor  = (128,128,255)
@@ -291,7 +374,6 @@ class Proj5GUI( QMainWindow ):
 		self.solver.setupWithScenario(self._scenario)
 
 		max_time = float( self.timeLimit.text() )
-		# TODO - start on a separate thread
 		self.view.clearEdges([(64,64,255)])				# get rid of edge labels but not point labels
 		self.numSolutions.setText( '--' )
 		self.tourCost.setText( '--' )
@@ -300,34 +382,64 @@ class Proj5GUI( QMainWindow ):
 		self.totalStates.setText( '--' )
 		self.prunedStates.setText( '--' )
 		self.statusBar.showMessage('Processing...')
-		#self.view.repaint()
-		#app.processEvents()
-		solve_func = 'self.solver.'+self.ALGORITHMS[self.algDropDown.currentIndex()][1]
-		results = eval(solve_func)(time_allowance=max_time )
+		self.view.repaint()
+
+		# The solver runs on its own thread so the window keeps repainting and
+		# can show each new bssf; generating or solving again waits until it is done
+		self.generateButton.setEnabled(False)
+		self.solveButton.setEnabled(False)
+		self.cancelButton.setEnabled(True)
+		self.solverThread = SolverThread( self.solver, self.ALGORITHMS[self.algDropDown.currentIndex()][1], max_time )
+		self.solverThread.progress.connect(self.solveProgress)
+		self.solverThread.done.connect(self.solveDone)
+		self.solverThread.start()
+
+	def cancelClicked(self):
+		self.solver.cancel()
+		self.cancelButton.setEnabled(False)
+		self.statusBar.showMessage('Cancelling...')
+
+	def showResults( self, results ):
+		if results['count'] is not None:
+			self.numSolutions.setText( '{}'.format(results['count']) )
+		self.tourCost.setText( '{}'.format(results['cost']) )
+		self.solvedIn.setText( '{:6.6f} seconds'.format(results['time']) )
+		if results.get('max') is not None:
+			self.maxQSize.setText( '{}'.format(results['max']))
+		if results.get('total') is not None:
+			self.totalStates.setText( '{}'.format(results['total']))
+		if results.get('pruned') is not None:
+			self.prunedStates.setText( '{}'.format(results['pruned']))
+
+	def solveProgress( self, results ):
+		self.showResults( results )
+		if results['soln'] is not None:
+			self._solution = results['soln']
+			self.displaySolution()
+
+	def solveDone( self, results ):
+		self.solverThread.wait()
+		self.solverThread = None
+		self.cancelButton.setEnabled(False)
+		self.solveButton.setEnabled(True)
+		self.checkGenInputs()
 		if results:
 			self.statusBar.showMessage('')
-			self.numSolutions.setText( '{}'.format(results['count']) )
-			self.tourCost.setText( '{}'.format(results['cost']) )
-			self.solvedIn.setText( '{:6.6f} seconds'.format(results['time']) )
+			self.showResults( results )
 			self._solution = results['soln']
-			if 'max' in results.keys():
-				self.maxQSize.setText( '{}'.format(results['max']))
-			if 'total' in results.keys():
-				self.totalStates.setText( '{}'.format(results['total']))
-			if 'pruned' in results.keys():
-				self.prunedStates.setText( '{}'.format(results['pruned']))
 			#if self._solution:
 			self.displaySolution()
 		else:
 			print( 'GOT NULL SOLUTION BACK!!' )		#probably shouldn't ever use this...
 		self.view.repaint()
-#		app.processEvents()
 
 	def checkGenInputs(self):
 		seed  = self.curSeed.text()
 		size = self.size.text()
 		diff = self.diffDropDown.currentText()
 
+		if self.solverThread:
+			return			# both stay disabled until the solve finishes
 		if self._scenario:
 			if self.genParams['seed'] == seed and \
 			   self.genParams['size'] == size and \
@@ -370,7 +482,11 @@ class Proj5GUI( QMainWindow ):
 		('Default                            ','defaultRandomTour'), \
 		('Greedy','greedy'), \
 		('Branch and Bound','branchAndBound'), \
-		('Fancy','fancy') \
+		('Fancy','fancy'), \
+		('Parallel Branch and Bound','parallelBranchAndBound'), \
+		('Lin-Kernighan','linKernighan'), \
+		('Simulated Annealing','simulatedAnnealing'), \
+		('Held-Karp','heldKarp') \
 	]															# whitespace hack to get longest to display correctly
 
 	def initUI( self ):
@@ -394,6 +510,7 @@ class Proj5GUI( QMainWindow ):
 		self.randSeedButton = QPushButton('Randomize Seed')
 		self.generateButton = QPushButton('Generate Scenario')
 		self.solveButton	= QPushButton('Solve TSP')
+		self.cancelButton	= QPushButton('Cancel')
 
 		self.curSeed		= QLineEdit('20')
 		self.curSeed.setFixedWidth(100)
@@ -462,6 +579,7 @@ class Proj5GUI( QMainWindow ):
 		h.addWidget( self.timeLimit )
 		h.addWidget( QLabel( 'seconds' ) )
 		h.addWidget( self.solveButton )
+		h.addWidget( self.cancelButton )
 		h.addStretch(1)
 		vbox.addLayout(h)
 
@@ -481,6 +599,7 @@ class Proj5GUI( QMainWindow ):
 
 		self.lastPath = (None,None)
 		self.solveButton.setEnabled(False)
+		self.cancelButton.setEnabled(False)
 
 		self.curSeed.textChanged.connect(self.checkGenInputs)
 		self.size.textChanged.connect(self.checkGenInputs)
@@ -488,6 +607,7 @@ class Proj5GUI( QMainWindow ):
 		self.randSeedButton.clicked.connect(self.randSeedClicked)
 		self.generateButton.clicked.connect(self.generateClicked)
 		self.solveButton.clicked.connect(self.solveClicked)
+		self.cancelButton.clicked.connect(self.cancelClicked)
 
 		self.diffDropDown.addItem('Easy                               ')					# Weird hack to make box wide enough to show all of last item
 		self.diffDropDown.addItem('Normal')
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+'''
+Headless batch runner for the TSP solvers: generates scenarios the same way the
+GUI does (size, seed, difficulty), runs TSPSolver methods on each with a time
+allowance, and writes one row of results per run as CSV or JSON.  JSON rows
+also carry the run's convergence curve: [time, cost] for every new BSSF, and
+with --profile its TSPProfile breakdown (printed to standard error as well).
+With --gap each row also gets the scenario's lower bound and the tour's
+optimality gap.
+
+	python3 TSPBenchmark.py --sizes 15 50 --seeds 20 21 --difficulties Hard \
+		--algorithms greedy branchAndBound --time-limit 10 --format csv
+'''
+
+import argparse
+import csv
+import json
+import math
+import os
+import re
+import sys
+
+import numpy as np
+
+from TSPSolver import *
+from TSPClasses import *
+from TSPProfile import PROFILER
+
+
+# Same data range and choices as Proj5GUI
+DATA_RANGE = { 'x':[-1.5,1.5], 'y':[-1.0,1.0] }
+DIFFICULTIES = [ 'Easy', 'Normal', 'Hard', 'Hard (Deterministic)' ]
+ALGORITHMS = [ 'defaultRandomTour', 'greedy', 'branchAndBound', 'fancy', 'linKernighan',
+			   'simulatedAnnealing', 'heldKarp' ]
+
+RESULT_FIELDS = [ 'size', 'seed', 'difficulty', 'algorithm',
+				  'cost', 'time', 'count', 'max', 'total', 'pruned', 'bound', 'gap' ]
+
+
+def newScenario( npoints, seed, difficulty, cache_dir=None ):
+	''' The scenario the GUI generates for this size, seed and difficulty.  With
+		cache_dir, it is saved there (cost matrix included) the first time and
+		memory-mapped from there afterwards.  NumPy's generator is seeded with seed
+		too, so that Hard mode, which the GUI thins at random, removes the same
+		edges every time. '''
+	if cache_dir:
+		path = os.path.join( cache_dir, '{}-{}-{}'.format(npoints, seed, re.sub(r'\W+', '', difficulty)) )
+		if os.path.exists( os.path.join(path, 'scenario.json') ):
+			return Scenario.load( path )
+	np.random.seed( seed )
+	points = generatePoints( npoints, seed, DATA_RANGE )
+	scenario = Scenario( city_locations=points, difficulty=difficulty, rand_seed=seed )
+	if cache_dir:
+		scenario.save( path, include_costs=True )
+		return Scenario.load( path )
+	return scenario
+
+
+class CurveRecorder( SolverListener ):
+	''' Records [time, cost] for each new BSSF a solver reports. '''
+	def __init__( self ):
+		self.curve = []
+
+	def on_new_bssf( self, results ):
+		self.curve.append( [results['time'], results['cost']] )
+
+
+def runOne( scenario, algorithm, time_allowance, report_gap=False ):
+	''' Returns the solver's results dictionary and its convergence curve. '''
+	solver = TSPSolver( None )
+	solver.setupWithScenario( scenario )
+	solver.setReportGap( report_gap )
+	recorder = CurveRecorder()
+	solver.addListener( recorder )
+	results = getattr( solver, algorithm )( time_allowance=time_allowance )
+	return results, recorder.curve
+
+
+def runBatch( sizes, seeds, difficulties, algorithms, time_allowance, progress=None, cache_dir=None,
+			  gaps=False ):
+	''' Runs every algorithm on every (size, seed, difficulty) scenario and
+		returns one dict per run, with the RESULT_FIELDS keys and 'curve'.  bound
+		and gap are None unless gaps is set. '''
+	rows = []
+	for size in sizes:
+		for seed in seeds:
+			for difficulty in difficulties:
+				scenario = newScenario( size, seed, difficulty, cache_dir )
+				if gaps:
+					# Worked out up front and cached, so that no run's time includes it
+					scenario.lowerBound()
+				for algorithm in algorithms:
+					results, curve = runOne( scenario, algorithm, time_allowance, gaps )
+					row = { 'size':size, 'seed':seed, 'difficulty':difficulty, 'algorithm':algorithm }
+					for field in RESULT_FIELDS[4:]:
+						row[field] = results.get( field )
+					row['curve'] = curve
+					if 'profile' in results:
+						row['profile'] = results['profile']
+					rows.append( row )
+					if progress:
+						progress( row )
+	return rows
+
+
+def writeRows( rows, out, fmt ):
+	if fmt == 'json':
+		# JSON has no infinity; an infinite cost (no tour found) becomes null
+		clean = [ {k:(None if isinstance(v,float) and math.isinf(v) else v) for k,v in row.items()} for row in rows ]
+		json.dump( clean, out, indent=1 )
+		out.write( '\n' )
+	else:
+		# CSV keeps one flat row per run, so it has no curves
+		writer = csv.DictWriter( out, fieldnames=RESULT_FIELDS, extrasaction='ignore' )
+		writer.writeheader()
+		writer.writerows( rows )
+
+
+def parseArgs( argv ):
+	parser = argparse.ArgumentParser( description='Run TSP solvers headless and tabulate the results.' )
+	parser.add_argument( '--sizes', type=int, nargs='+', default=[15] )
+	parser.add_argument( '--seeds', type=int, nargs='+', default=[20] )
+	parser.add_argument( '--difficulties', nargs='+', default=['Hard (Deterministic)'], choices=DIFFICULTIES )
+	parser.add_argument( '--algorithms', nargs='+', default=ALGORITHMS,
+						 help='TSPSolver method names (default: %(default)s)' )
+	parser.add_argument( '--time-limit', type=float, default=60.0, help='time allowance per run, in seconds' )
+	parser.add_argument( '--format', choices=['csv','json'], default='csv' )
+	parser.add_argument( '--output', help='file to write (default: standard output)' )
+	parser.add_argument( '--cache-dir', help='directory to save generated scenarios in and reuse them from' )
+	parser.add_argument( '--profile', action='store_true', help='record call counts and time per phase' )
+	parser.add_argument( '--gap', action='store_true',
+						 help="report each scenario's lower bound and each tour's optimality gap" )
+	args = parser.parse_args( argv )
+	for algorithm in args.algorithms:
+		if not callable( getattr(TSPSolver, algorithm, None) ):
+			parser.error( 'unknown algorithm: {}'.format(algorithm) )
+	return args
+
+
+def main( argv=None ):
+	args = parseArgs( argv )
+	PROFILER.enable( args.profile )
+
+	def progress( row ):
+		gap = '' if row['gap'] is None else ' gap={:.2f}%'.format(row['gap'])
+		print( '{size:>6} {seed:>6} {difficulty:<21} {algorithm:<24} cost={cost} time={time:.3f}'.format(**row) + gap,
+			   file=sys.stderr )
+		for line in PROFILER.report( row['profile'] ) if 'profile' in row else []:
+			print( '\t' + line, file=sys.stderr )
+
+	rows = runBatch( args.sizes, args.seeds, args.difficulties, args.algorithms, args.time_limit, progress,
+					 args.cache_dir, args.gap )
+	if args.output:
+		with open( args.output, 'w', newline='' ) as out:
+			writeRows( rows, out, args.format )
+	else:
+		writeRows( rows, sys.stdout, args.format )
+	return 0
+
+
+
+if __name__ == '__main__':
+	sys.exit( main() )
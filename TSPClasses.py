@@ -1,43 +1,321 @@
 #!/usr/bin/python3
 
 
+import json
 import math
 import numpy as np
+import os
 import random
 import time
 
+from TSPProfile import PROFILER, profiled
+
+try:
+	from scipy.spatial import cKDTree
+except ImportError:
+	cKDTree = None		# Scenario falls back to its own _GridIndex
 
 
 class TSPSolution:
-	def __init__( self, listOfCities):
+	''' A tour, as a list of City objects.  Treat it as immutable: the cost is
+		worked out on first use (unless passed in, e.g. from Scenario.routeCosts)
+		and then kept. '''
+	def __init__( self, listOfCities, cost=None ):
 		self.route = listOfCities
-		self.cost = self._costOfRoute()
+		self._cost = cost if cost is None or cost == np.inf else int(cost)
 		#print( [c._index for c in listOfCities] )
 
+	@property
+	def cost( self ):
+		if self._cost is None:
+			self._cost = self._costOfRoute()
+		return self._cost
+
+	def _edgeCosts( self ):
+		# Cost of every edge of the tour (including the closing edge), gathered
+		# from the scenario's precomputed cost matrix in one shot
+		idx = np.array( [c._index for c in self.route] )
+		return self.route[0]._scenario.edgeCosts( idx, np.roll(idx, -1) )
+
 	def _costOfRoute( self ):
-		cost = 0
-		last = self.route[0]
-		for city in self.route[1:]:
-			cost += last.costTo(city)
-			last = city
-		cost += self.route[-1].costTo( self.route[0] )
-		return cost
+		with PROFILER.phase('TSPSolution.cost'):
+			cost = self._edgeCosts().sum()
+		if cost >= Scenario.INF_COST:
+			return np.inf
+		return int(cost)
 
 	def enumerateEdges( self ):
-		elist = []
-		c1 = self.route[0]
-		for c2 in self.route[1:]:
-			dist = c1.costTo( c2 )
-			if dist == np.inf:
-				return None
-			elist.append( (c1, c2, int(math.ceil(dist))) )
-			c1 = c2
-		dist = self.route[-1].costTo( self.route[0] )
-		if dist == np.inf:
+		costs = self._edgeCosts()
+		if (costs >= Scenario.INF_COST).any():
 			return None
-		elist.append( (self.route[-1], self.route[0], int(math.ceil(dist))) )
-		return elist
+		ncities = len(self.route)
+		return [ (self.route[i], self.route[(i+1)%ncities], int(costs[i])) for i in range(ncities) ]
+
+
+class Tour:
+	"""
+	A mutable tour for local search: the city indices in tour order plus each
+	city's position in it.  Moves (swaps, segment reversals and relocations) are
+	priced by their change in cost without touching the tour, and applied in
+	place.  A TSPSolution is only built when toSolution is called.
+
+	Costs come from Scenario.costLookup(), so a tour using a missing edge
+	costs at least Scenario.INF_COST rather than inf.
+	"""
+	# Reversal deltas use prefix sums of the tour's edge costs, rebuilt lazily
+	# (O(n)) after a change.  Until then, runs shorter than n/RUN_SCAN_RATIO
+	# are priced by walking them instead.
+	RUN_SCAN_RATIO = 8
+
+	def __init__( self, order, cost_matrix ):
+		self._cost_matrix = cost_matrix
+		self._order = [int(c) for c in order]
+		self._pos = [0] * len(self._order)
+		for p, c in enumerate(self._order):
+			self._pos[c] = p
+		self._forward = None
+		self._backward = None
+		self._journal = None
+		idx = np.array(self._order)
+		self.cost = int(cost_matrix[idx, np.roll(idx, -1)].sum())
+
+	def __len__( self ):
+		return len(self._order)
+
+	def order( self ):
+		return list(self._order)
+
+	def cityAt( self, p ):
+		return self._order[p % len(self._order)]
+
+	def positionOf( self, city ):
+		return self._pos[city]
+
+	def succ( self, city ):
+		return self._order[(self._pos[city] + 1) % len(self._order)]
+
+	def pred( self, city ):
+		return self._order[self._pos[city] - 1]
+
+	def isValid( self ):
+		return self.cost < Scenario.INF_COST
+
+	def toSolution( self, cities ):
+		# The tracked cost is exact for a valid tour, so the solution need not
+		# gather it again
+		route = [cities[c] for c in self._order]
+		return TSPSolution( route, self.cost ) if self.isValid() else TSPSolution( route )
+
+	def _buildPrefixSums( self ):
+		idx = np.array(self._order)
+		following = np.roll(idx, -1)
+		forward = np.zeros(len(idx) + 1, dtype=np.int64)
+		backward = np.zeros(len(idx) + 1, dtype=np.int64)
+		np.cumsum(self._cost_matrix[idx, following], out=forward[1:])
+		np.cumsum(self._cost_matrix[following, idx], out=backward[1:])
+		self._forward = forward.tolist()
+		self._backward = backward.tolist()
+
+	def runCosts( self, s, e ):
+		''' Cost of the edges inside the run of positions s..e (wrapping around),
+			walked forwards and walked backwards. '''
+		n = len(self._order)
+		length = (e - s) % n
+		if self._forward is None and length * self.RUN_SCAN_RATIO < n:
+			C = self._cost_matrix
+			forward = backward = 0
+			a = self._order[s]
+			for m in range(1, length + 1):
+				b = self._order[(s + m) % n]
+				forward += C[a, b]
+				backward += C[b, a]
+				a = b
+			return int(forward), int(backward)
+		if self._forward is None:
+			self._buildPrefixSums()
+		F, B = self._forward, self._backward
+		if s <= e:
+			return F[e] - F[s], B[e] - B[s]
+		return F[n] - F[s] + F[e], B[n] - B[s] + B[e]
+
+	def reversalDelta( self, s, e ):
+		''' Change in cost from reversing the run of positions s..e, which swaps
+			edges (t[s-1],t[s]) and (t[e],t[e+1]) for (t[s-1],t[e]) and (t[s],t[e+1]). '''
+		C = self._cost_matrix
+		order = self._order
+		before = order[s - 1]
+		after = order[(e + 1) % len(order)]
+		forward, backward = self.runCosts(s, e)
+		return int(C[before, order[e]] + C[order[s], after] - C[before, order[s]] - C[order[e], after]
+				   + backward - forward)
+
+	def reverse( self, s, e ):
+		self.cost += self.reversalDelta(s, e)
+		if self._journal is not None:
+			# Undone by reversing the same run, found by its end cities since a
+			# relocation can shift every position
+			self._journal.append( ('reverse', self.cityAt(e), self.cityAt(s)) )
+		self._reverseRun(s, e)
+
+	def _reverseRun( self, s, e ):
+		order, pos = self._order, self._pos
+		n = len(order)
+		s, e = s % n, e % n
+		if s <= e:
+			order[s:e + 1] = order[e:s - 1 if s > 0 else None:-1]
+			for i in range(s, e + 1):
+				pos[order[i]] = i
+		else:
+			length = (e - s) % n + 1
+			for m in range(length // 2):
+				i = (s + m) % n
+				j = (e - m) % n
+				order[i], order[j] = order[j], order[i]
+				pos[order[i]] = i
+				pos[order[j]] = j
+		self._forward = self._backward = None
+
+	def swapDelta( self, p, q ):
+		''' Change in cost from exchanging the cities at positions p and q. '''
+		C = self._cost_matrix
+		order = self._order
+		n = len(order)
+		p, q = p % n, q % n
+		if p == q:
+			return 0
+		if (p + 1) % n != q and (q + 1) % n == p:
+			p, q = q, p
+		a, b = order[p], order[q]
+		before_a, after_b = order[p - 1], order[(q + 1) % n]
+		if (p + 1) % n == q:
+			# Adjacent: before_a -> a -> b -> after_b becomes before_a -> b -> a -> after_b
+			if n == 2:
+				return 0
+			return int(C[before_a, b] + C[b, a] + C[a, after_b] - C[before_a, a] - C[a, b] - C[b, after_b])
+		after_a, before_b = order[(p + 1) % n], order[q - 1]
+		return int(C[before_a, b] + C[b, after_a] + C[before_b, a] + C[a, after_b]
+				   - C[before_a, a] - C[a, after_a] - C[before_b, b] - C[b, after_b])
+
+	def swap( self, p, q ):
+		self.cost += self.swapDelta(p, q)
+		if self._journal is not None:
+			# Undone by swapping the same two cities back, wherever they are by then
+			self._journal.append( ('swap', self.cityAt(p), self.cityAt(q)) )
+		self._swapCities(p, q)
+
+	def _swapCities( self, p, q ):
+		order, pos = self._order, self._pos
+		p, q = p % len(order), q % len(order)
+		order[p], order[q] = order[q], order[p]
+		pos[order[p]] = p
+		pos[order[q]] = q
+		self._forward = self._backward = None
+
+	def relocationDelta( self, s, length, x ):
+		''' Change in cost from moving the run of length cities starting at position
+			s to between city x and its successor.  x must not be in the run or be
+			the city just before it. '''
+		C = self._cost_matrix
+		order = self._order
+		n = len(order)
+		first = order[s % n]
+		last = order[(s + length - 1) % n]
+		before = order[s - 1]
+		after = order[(s + length) % n]
+		y = self.succ(x)
+		return int(C[before, after] + C[x, first] + C[last, y]
+				   - C[before, first] - C[last, after] - C[x, y])
+
+	def relocate( self, s, length, x ):
+		self.cost += self.relocationDelta(s, length, x)
+		if self._journal is not None:
+			# Undone by moving the run, by its first city, back after the city before it
+			self._journal.append( ('relocate', self.cityAt(s), length, self.cityAt(s - 1)) )
+		self._moveRun(s, length, x)
+
+	def _moveRun( self, s, length, x ):
+		order, pos = self._order, self._pos
+		n = len(order)
+		s = s % n
+		p = pos[x]
+		# Only the positions between the run and x change, unless that stretch
+		# wraps past the end of the list
+		if s + length <= p:
+			lo, hi = s, p + 1
+			order[lo:hi] = order[s + length:p + 1] + order[s:s + length]
+		elif p < s and s + length <= n:
+			lo, hi = p + 1, s + length
+			order[lo:hi] = order[s:s + length] + order[p + 1:s]
+		else:
+			rotated = order[s:] + order[:s]
+			run, rest = rotated[:length], rotated[length:]
+			k = (p - s) % n - length + 1
+			order[:] = rest[:k] + run + rest[k:]
+			lo, hi = 0, n
+		for i in range(lo, hi):
+			pos[order[i]] = i
+		self._forward = self._backward = None
+
+	def checkpoint( self ):
+		''' Starts recording moves (dropping any earlier record) so rollback can
+			undo them, which for a few local moves is much cheaper than copying the
+			tour. '''
+		self._journal = []
+		self._checkpoint_cost = self.cost
+
+	def rollback( self ):
+		''' Undoes every move since checkpoint, and stops recording. '''
+		journal, self._journal = self._journal, None
+		for move in reversed(journal):
+			if move[0] == 'reverse':
+				self._reverseRun(self._pos[move[1]], self._pos[move[2]])
+			elif move[0] == 'swap':
+				self._swapCities(self._pos[move[1]], self._pos[move[2]])
+			else:
+				self._moveRun(self._pos[move[1]], move[2], move[3])
+		self.cost = self._checkpoint_cost
+
+
+# The random module's generator is a 32-bit Mersenne Twister, as is NumPy's
+# MT19937, so its draws can be reproduced exactly -- and in bulk -- with NumPy
+# by moving the state across and back.
 
+def _generatorFromRandom():
+	''' An MT19937 in the random module's current state. '''
+	internal_state = random.getstate()[1]
+	generator = np.random.MT19937()
+	generator.state = {'bit_generator': 'MT19937',
+					   'state': {'key': np.array(internal_state[:-1], dtype=np.uint32),
+								 'pos': internal_state[-1]}}
+	return generator
+
+def _syncRandomTo( generator ):
+	''' Puts the random module in the MT19937's state. '''
+	version, _, gauss_next = random.getstate()
+	state = generator.state['state']
+	random.setstate( (version, tuple(int(v) for v in state['key']) + (int(state['pos']),), gauss_next) )
+
+def randomUniforms( count ):
+	''' The next count values of random.random() (so also of
+		random.uniform(0.0,1.0)), as an array, advancing the random module just
+		as calling it count times would. '''
+	generator = _generatorFromRandom()
+	raw = generator.random_raw( 2*count ).reshape(count, 2)
+	_syncRandomTo( generator )
+	# random.random() builds a 53-bit float from the top 27 and 26 bits of two draws
+	return ( (raw[:,0] >> 5).astype(np.float64)*67108864.0 + (raw[:,1] >> 6) ) * (1.0/9007199254740992.0)
+
+def generatePoints( npoints, seed, data_range ):
+	''' City locations as an (npoints x 2) array, uniform over data_range and
+		identical to the points Proj5GUI has always generated for this seed. '''
+	random.seed( seed )
+	uniforms = randomUniforms( 2*npoints ).reshape(npoints, 2)
+	xr = data_range['x']
+	yr = data_range['y']
+	points = np.empty( (npoints,2), dtype=np.float64 )
+	points[:,0] = xr[0] + (xr[1]-xr[0])*uniforms[:,0]
+	points[:,1] = yr[0] + (yr[1]-yr[0])*uniforms[:,1]
+	return points
 
 def nameForInt( num ):
 	if num == 0:
@@ -58,41 +336,360 @@ class Scenario:
 
 	HARD_MODE_FRACTION_TO_REMOVE = 0.20 # Remove 20% of the edges
 
-	def __init__( self, city_locations, difficulty, rand_seed ):
+	# Cost-matrix entry for a missing edge (removed edges and self-edges).  Large
+	# enough that any route using one sums past it, small enough that summing a
+	# whole route of them cannot overflow int64.
+	INF_COST = 1 << 40
+
+	# Rows of the cost matrix computed per vectorized block while building it
+	COST_BLOCK_ROWS = 256
+
+	# Largest sparse scenario getCostMatrix builds the full matrix for (some
+	# 128 MB of int64); past this its costs only come from edgeCosts, costRows
+	# and costLookup
+	SPARSE_MATRIX_MAX_CITIES = 4000
+
+	''' <summary>
+		city_locations is either a sequence of points with x() and y() methods (such
+		as QPointF) or an (n x 2) array of coordinates, e.g. from generatePoints.
+		elevations, if given, replaces the random elevations of Normal and Hard modes;
+		the random draws are still made, so the same edges get removed.
+		</summary> '''
+	@profiled('Scenario.__init__')
+	def __init__( self, city_locations, difficulty, rand_seed, sparse_edges=False, elevations=None ):
 		self._difficulty = difficulty
 
+		# Cities are stored as contiguous arrays; City objects are just views
+		# onto one index of them (see getCities)
+		if isinstance( city_locations, np.ndarray ):
+			locations = city_locations.reshape(-1, 2)
+			self._xs = np.array( locations[:,0], dtype=np.float64 )
+			self._ys = np.array( locations[:,1], dtype=np.float64 )
+		else:
+			self._xs = np.array( [pt.x() for pt in city_locations], dtype=np.float64 )
+			self._ys = np.array( [pt.y() for pt in city_locations], dtype=np.float64 )
+		ncities = len(self._xs)
 		if difficulty == "Normal" or difficulty == "Hard":
-			self._cities = [City( pt.x(), pt.y(), \
-								  random.uniform(0.0,1.0) \
-								) for pt in city_locations]
+			self._elevations = randomUniforms( ncities )
 		elif difficulty == "Hard (Deterministic)":
 			random.seed( rand_seed )
-			self._cities = [City( pt.x(), pt.y(), \
-								  random.uniform(0.0,1.0) \
-								) for pt in city_locations]
+			self._elevations = randomUniforms( ncities )
 		else:
-			self._cities = [City( pt.x(), pt.y() ) for pt in city_locations]
-
+			self._elevations = np.zeros( ncities, dtype=np.float64 )
+		if elevations is not None:
+			assert( len(elevations) == ncities )
+			self._elevations = np.array( elevations, dtype=np.float64 )
+		self._cities = None
 
-		num = 0
-		for city in self._cities:
-			#if difficulty == "Hard":
-			city.setScenario(self)
-			city.setIndexAndName( num, nameForInt( num+1 ) )
-			num += 1
-
-		# Assume all edges exists except self-edges
-		ncities = len(self._cities)
-		self._edge_exists = ( np.ones((ncities,ncities)) - np.diag( np.ones((ncities)) ) ) > 0
+		# Assume all edges exists except self-edges.  With sparse_edges only the
+		# removed edges are stored (as a bitmap over src*n+dst, and only once edges
+		# are thinned), and costs are computed as needed rather than from a full
+		# cost matrix, so very large scenarios fit in memory.
+		self._sparse_edges = sparse_edges
+		if sparse_edges:
+			self._edge_exists = None
+			self._removed_edges = None
+		else:
+			self._edge_exists = ~np.eye( ncities, dtype=bool )
+		self._cost_matrix = None
+		self._spatial_index = None
+		self._neighbors = {}
+		self._lower_bound = None
 
 		if difficulty == "Hard":
 			self.thinEdges()
 		elif difficulty == "Hard (Deterministic)":
 			self.thinEdges(deterministic=True)
 
+	# Bumped whenever the layout written by save changes
+	SAVE_FORMAT_VERSION = 1
+
+	''' <summary>
+		Writes the scenario to the directory path (created if needed) as a small JSON
+		header plus one .npy file per array: coordinates, elevations, the edge set
+		and, with include_costs, the cost matrix (built first if need be).
+		</summary> '''
+	def save( self, path, include_costs=False ):
+		os.makedirs( path, exist_ok=True )
+		arrays = { 'xs':self._xs, 'ys':self._ys, 'elevations':self._elevations }
+		if self._edge_exists is not None:
+			arrays['edge_exists'] = self._edge_exists
+		elif self._removed_edges is not None:
+			arrays['removed_edges'] = self._removed_edges
+		if include_costs:
+			arrays['cost_matrix'] = self.getCostMatrix()
+		for name, array in arrays.items():
+			np.save( os.path.join(path, name + '.npy'), array )
+
+		header = { 'version':self.SAVE_FORMAT_VERSION, 'difficulty':self._difficulty,
+				   'ncities':len(self._xs), 'sparse_edges':self._sparse_edges,
+				   'arrays':sorted(arrays) }
+		# Written last, so a directory without it was never completely saved
+		with open( os.path.join(path, 'scenario.json'), 'w' ) as f:
+			json.dump( header, f, indent=1 )
+
+	''' <summary>
+		Opens a scenario written by save.  With mmap (the default) the arrays are
+		memory-mapped read-only rather than read in, so processes opening the same
+		scenario share its pages.
+		</summary> '''
+	@classmethod
+	def load( cls, path, mmap=True ):
+		with open( os.path.join(path, 'scenario.json') ) as f:
+			header = json.load( f )
+		if header['version'] != cls.SAVE_FORMAT_VERSION:
+			raise Exception( 'Unsupported scenario format version: {}'.format(header['version']) )
+
+		def array( name ):
+			if name not in header['arrays']:
+				return None
+			return np.load( os.path.join(path, name + '.npy'), mmap_mode='r' if mmap else None )
+
+		scenario = cls.__new__( cls )
+		scenario._difficulty = header['difficulty']
+		scenario._sparse_edges = header['sparse_edges']
+		scenario._xs = array( 'xs' )
+		scenario._ys = array( 'ys' )
+		scenario._elevations = array( 'elevations' )
+		scenario._edge_exists = array( 'edge_exists' )
+		scenario._removed_edges = array( 'removed_edges' )
+		scenario._cost_matrix = array( 'cost_matrix' )
+		scenario._cities = None
+		scenario._spatial_index = None
+		scenario._neighbors = {}
+		scenario._lower_bound = None
+		return scenario
+
 	def getCities( self ):
+		# Built on first use; the same City objects are handed out every time,
+		# so they can be compared with 'is'
+		if self._cities is None:
+			self._cities = [City( self, i ) for i in range(len(self._xs))]
 		return self._cities
 
+	def edgeExists( self, src, dst ):
+		''' Whether the edges src->dst exist, for (broadcastable) arrays of city indices. '''
+		if self._edge_exists is not None:
+			return self._edge_exists[src, dst]
+		src = np.asarray(src, dtype=np.int64)
+		dst = np.asarray(dst, dtype=np.int64)
+		exists = src != dst
+		if self._removed_edges is not None:
+			keys = src * len(self._xs) + dst
+			exists &= ( (self._removed_edges[keys >> 3] >> (keys & 7).astype(np.uint8)) & 1 ) == 0
+		return exists
+
+	def isSymmetric( self ):
+		''' Whether every edge costs the same both ways, as only in Easy mode. '''
+		return self._difficulty == 'Easy'
+
+	def routeCosts( self, routes ):
+		''' Cost of each route, closing edge included, for an array of city indices
+			with one route per row (or a single route): a float array, inf for
+			routes that use a missing edge.  Evaluates many candidate routes in
+			one gather. '''
+		routes = np.asarray( routes )
+		costs = self.edgeCosts( routes, np.roll(routes, -1, axis=-1) ).sum( axis=-1 ).astype(np.float64)
+		costs[costs >= self.INF_COST] = np.inf
+		return costs
+
+	''' <summary>
+		Matrix of edge costs, cost_matrix[i,j] being exactly City.costTo from city i
+		to city j, with INF_COST standing in for infinity (missing or self-edges).
+		Built on first use and cached.  Sparse scenarios of more than
+		SPARSE_MATRIX_MAX_CITIES cities refuse to build it.
+		</summary> '''
+	def getCostMatrix( self ):
+		if self._cost_matrix is None:
+			if self._sparse_edges and len(self._xs) > self.SPARSE_MATRIX_MAX_CITIES:
+				raise Exception( 'A sparse scenario of {} cities (over {}) has no cost matrix; '
+								 'use edgeCosts, costRows or costLookup'.format(len(self._xs), self.SPARSE_MATRIX_MAX_CITIES) )
+			self._cost_matrix = self._buildCostMatrix()
+		return self._cost_matrix
+
+	def costLookup( self ):
+		''' Edge costs to index like getCostMatrix, lookup[src, dst], for code that
+			reads only some of them: the cost matrix itself, except for sparse
+			scenarios too big for one, whose costs are computed as they are read. '''
+		if self._cost_matrix is None and self._sparse_edges and len(self._xs) > self.SPARSE_MATRIX_MAX_CITIES:
+			return _CostLookup( self )
+		return self.getCostMatrix()
+
+	def edgeCosts( self, src, dst ):
+		''' Costs of the edges src->dst, for (broadcastable) arrays of city indices,
+			as in getCostMatrix.  Sparse scenarios compute them rather than
+			building the full matrix. '''
+		if self._sparse_edges and self._cost_matrix is None:
+			return self._computeCosts( src, dst )
+		return self.getCostMatrix()[src, dst]
+
+	def costRows( self, rows ):
+		''' Rows of the cost matrix for the given city indices, as a new array. '''
+		if self._sparse_edges and self._cost_matrix is None:
+			return self._computeCosts( np.asarray(rows)[:,None], np.arange(len(self._xs))[None,:] )
+		return self.getCostMatrix()[rows]
+
+	def _computeCosts( self, src, dst ):
+		xs, ys, elevations = self._xs, self._ys, self._elevations
+		# Same operations, in the same order, as City.costTo so results match bit for bit
+		cost = np.sqrt( (xs[dst] - xs[src])**2 +
+						(ys[dst] - ys[src])**2 )
+		if not self._difficulty == 'Easy':
+			cost = cost + (elevations[dst] - elevations[src])
+			cost = np.maximum( cost, 0.0 )
+		cost = np.ceil( cost * City.MAP_SCALE ).astype(np.int64)
+		return np.where( self.edgeExists(src, dst), cost, self.INF_COST )
+
+	# Cities fetched per city for nearestNeighbors(k), as a multiple of k, so
+	# that k remain once missing edges are dropped
+	NEIGHBOR_OVERFETCH = 2
+
+	def nearestNeighbors( self, k ):
+		''' Candidate neighbor lists for heuristics: (out_neighbors, in_neighbors),
+			two (n x k) int arrays.  Row i of out_neighbors holds, cheapest edge
+			first, the cities nearest city i by coordinates that i has an edge to;
+			in_neighbors likewise for edges into i.  Rows short of k valid cities
+			are padded with -1.  Uses a spatial index (a k-d tree when SciPy is
+			available, else a grid), so this is O(n k log n) rather than O(n^2), and
+			the result is cached. '''
+		ncities = len(self._xs)
+		k = max(0, min(k, ncities - 1))
+		if k not in self._neighbors:
+			with PROFILER.phase('Scenario.nearestNeighbors'):
+				self._neighbors[k] = self._findNeighbors( k )
+		return self._neighbors[k]
+
+	def _findNeighbors( self, k ):
+		ncities = len(self._xs)
+		fetch = min(ncities - 1, self.NEIGHBOR_OVERFETCH * k + 4) if k > 0 else 0
+		if self._spatial_index is None:
+			points = np.column_stack( (self._xs, self._ys) )
+			self._spatial_index = cKDTree( points ) if cKDTree is not None else _GridIndex( points )
+		near = _nearestOthers( self._spatial_index, fetch )
+		cities = np.arange(ncities)[:,None]
+		# Just these n*fetch costs, without building the whole cost matrix for them
+		edge_costs = self.edgeCosts if self._cost_matrix is not None else self._computeCosts
+		result = []
+		for costs in (edge_costs(cities, near), edge_costs(near, cities)):
+			# Cheapest first, nearest first among equal costs, missing edges last
+			ranked = np.argsort( costs, axis=1, kind='stable' )[:, :k]
+			neighbors = np.take_along_axis( near, ranked, axis=1 )
+			neighbors[np.take_along_axis(costs, ranked, axis=1) >= self.INF_COST] = -1
+			result.append( neighbors )
+		return tuple(result)
+
+	# Candidate neighbors per city (see nearestNeighbors) whose edges lowerBound
+	# takes its subgradient steps on
+	LOWER_BOUND_NEIGHBORS = 20
+	# Subgradient iterations spent on each Lagrangian relaxation
+	LOWER_BOUND_ITERATIONS = 100
+
+	def lowerBound( self ):
+		''' A lower bound on the cost of any tour, for judging how close to optimal
+			a tour is: inf when no tour can exist.  It is a Lagrangian bound: with
+			symmetric costs the Held-Karp 1-tree bound, and with asymmetric ones the
+			assignment relaxation (every city left and entered once, subtours
+			allowed) plus a 1-tree bound on what its reduced costs still add up to
+			around a tour.  The prices are improved by LOWER_BOUND_ITERATIONS
+			subgradient steps on the edges to each city's LOWER_BOUND_NEIGHBORS
+			candidate neighbors, and the bound for the best of them is then taken
+			over every edge, a row of costs at a time: O(n^2) time but only O(n k)
+			memory, so it never needs the cost matrix.  Computed on first use and
+			cached. '''
+		if self._lower_bound is None:
+			with PROFILER.phase('Scenario.lowerBound'):
+				bound = self._lagrangianBound()
+			self._lower_bound = bound if bound < self.INF_COST else math.inf
+		return self._lower_bound
+
+	def _lagrangianBound( self ):
+		ncities = len(self._xs)
+		if ncities < 3:
+			# The cheapest edges out of and into each city are the tour
+			return self._reductionBound()
+		cities = np.arange(ncities)
+		out_neighbors, in_neighbors = self.nearestNeighbors( self.LOWER_BOUND_NEIGHBORS )
+		k = out_neighbors.shape[1]
+		src = np.concatenate( (np.repeat(cities, k), in_neighbors.ravel()) )
+		dst = np.concatenate( (out_neighbors.ravel(), np.repeat(cities, k)) )
+		listed = (src >= 0) & (dst >= 0)
+		src, dst = src[listed], dst[listed]
+		iterations = self.LOWER_BOUND_ITERATIONS
+
+		if self.isSymmetric():
+			return self._roundBound( _oneTreeBound(ncities, src, dst, self._floatCosts(src, dst),
+												   lambda city: self._floatCosts(city, cities), iterations) )
+
+		col_duals = _columnDuals( ncities, src, dst, self._floatCosts(src, dst), iterations )
+		row_duals = self._rowDuals( col_duals )
+		if row_duals is None:
+			return self.INF_COST
+		# A tour costs the duals plus its reduced costs, which are nonnegative,
+		# and either way round an edge costs at least its cheaper direction
+		def reduced( src, dst ):
+			return self._floatCosts( src, dst ) - row_duals[src] - col_duals[dst]
+		bound = _oneTreeBound( ncities, src, dst, np.minimum(reduced(src, dst), reduced(dst, src)),
+							   lambda city: np.minimum(reduced(city, cities), reduced(cities, city)), iterations )
+		return self._roundBound( row_duals.sum() + col_duals.sum() + bound )
+
+	def _roundBound( self, bound ):
+		if math.isinf( bound ):
+			return self.INF_COST
+		# Tours cost whole numbers; the margin covers floating-point rounding
+		return int( math.ceil(bound - 1e-6 * len(self._xs)) )
+
+	def _floatCosts( self, src, dst ):
+		''' edgeCosts as floats, with np.inf for missing edges. '''
+		costs = self.edgeCosts( src, dst ).astype( np.float64 )
+		costs[costs >= self.INF_COST] = np.inf
+		return costs
+
+	def _rowDuals( self, col_duals ):
+		''' The largest row prices the column prices col_duals allow in an
+			assignment bound: each row's cheapest edge at those prices, over the
+			whole row.  None when some city cannot be left or entered at all. '''
+		ncities = len(self._xs)
+		cities = np.arange(ncities)
+		row_duals = np.empty( ncities )
+		entered = np.zeros( ncities, dtype=bool )
+		for start in range(0, ncities, self.COST_BLOCK_ROWS):
+			rows = cities[start:start+self.COST_BLOCK_ROWS]
+			block = self.costRows( rows )
+			entered |= (block < self.INF_COST).any( axis=0 )
+			row_duals[rows] = np.where( block < self.INF_COST, block - col_duals, np.inf ).min( axis=1 )
+		if np.isinf(row_duals).any() or not entered.all():
+			return None
+		return row_duals
+
+	def _reductionBound( self ):
+		# A row at a time, in blocks, so as not to need a second n x n array
+		ncities = len(self._xs)
+		cities = np.arange(ncities)
+		row_mins = np.empty( ncities, dtype=np.int64 )
+		col_mins = np.full( ncities, self.INF_COST, dtype=np.int64 )
+		for start in range(0, ncities, self.COST_BLOCK_ROWS):
+			rows = cities[start:start+self.COST_BLOCK_ROWS]
+			block = self.costRows( rows )
+			row_mins[rows] = block.min( axis=1 )
+			# A missing edge stays at INF_COST rather than being reduced
+			reduced = np.where( block < self.INF_COST, block - row_mins[rows,None], self.INF_COST )
+			np.minimum( col_mins, reduced.min(axis=0), out=col_mins )
+		if ncities == 0:
+			return 0
+		if row_mins.max() >= self.INF_COST or col_mins.max() >= self.INF_COST:
+			return self.INF_COST
+		return int( row_mins.sum() + col_mins.sum() )
+
+	@profiled('Scenario.buildCostMatrix')
+	def _buildCostMatrix( self ):
+		ncities = len(self._xs)
+		cities = np.arange(ncities)
+		cost_matrix = np.empty( (ncities,ncities), dtype=np.int64 )
+		for start in range(0, ncities, self.COST_BLOCK_ROWS):
+			rows = cities[start:start+self.COST_BLOCK_ROWS]
+			cost_matrix[rows] = self._computeCosts( rows[:,None], cities[None,:] )
+		return cost_matrix
+
 
 	def randperm( self, n ):				#isn't there a numpy function that does this and even gets called in Solver?
 		perm = np.arange(n)
@@ -103,50 +700,463 @@ class Scenario:
 			perm[randind] = save
 		return perm
 
+	@profiled('Scenario.thinEdges')
 	def thinEdges( self, deterministic=False ):
-		ncities = len(self._cities)
+		ncities = len(self._xs)
 		edge_count = ncities*(ncities-1) # can't have self-edge
 		num_to_remove = np.floor(self.HARD_MODE_FRACTION_TO_REMOVE*edge_count)
 
-		can_delete	= self._edge_exists.copy()
-
 		# Set aside a route to ensure at least one tour exists
 		route_keep = np.random.permutation( ncities )
 		if deterministic:
 			route_keep = self.randperm( ncities )
-		for i in range(ncities):
-			can_delete[route_keep[i],route_keep[(i+1)%ncities]] = False
-
-		# Now remove edges until 
-		while num_to_remove > 0:
-			if deterministic:
-				src = random.randint(0,ncities-1)
-				dst = random.randint(0,ncities-1)
-			else:
-				src = np.random.randint(ncities)
-				dst = np.random.randint(ncities)
-			if self._edge_exists[src,dst] and can_delete[src,dst]:
-				self._edge_exists[src,dst] = False
-				num_to_remove -= 1
 
+		if self._edge_exists is not None:
+			can_delete	= self._edge_exists.copy()
+			can_delete[route_keep, np.roll(route_keep, -1)] = False
+			removable = can_delete.ravel()
+			num_to_remove = int(min(num_to_remove, removable.sum()))
+
+			def is_removable( keys ):
+				return removable[keys]
+
+			def mark_removed( keys ):
+				removable[keys] = False
+				self._edge_exists.flat[keys] = False
+		else:
+			keep_next = np.empty( ncities, dtype=np.int64 )
+			keep_next[route_keep] = np.roll( route_keep, -1 )
+			removed = np.zeros( (ncities*ncities + 7) // 8, dtype=np.uint8 )
+			num_to_remove = int(min(num_to_remove, edge_count - (ncities if ncities > 1 else 0)))
 
+			def is_removable( keys ):
+				src, dst = np.divmod( keys, ncities )
+				return ( (src != dst) & (keep_next[src] != dst) &
+						 ( (removed[keys >> 3] >> (keys & 7).astype(np.uint8)) & 1 == 0 ) )
+
+			def mark_removed( keys ):
+				keys = np.sort( keys )
+				bits = np.left_shift( 1, keys & 7 ).astype(np.uint8)
+				starts = np.flatnonzero( np.diff(keys >> 3, prepend=-1) )
+				removed[keys[starts] >> 3] |= np.bitwise_or.reduceat( bits, starts )
+
+		# Now remove edges, a block of random picks at a time.  Most picks are
+		# removable, so a few per edge is usually one block even for small scenarios
+		block_size = int( min(self.REPLAY_BLOCK_SIZE, 4*num_to_remove + 64) )
+		if deterministic:
+			self._replayRandomEdgePicks( is_removable, mark_removed, num_to_remove, block_size )
+		else:
+			self._pickEdgesToRemove( lambda: np.random.randint(ncities*ncities, size=block_size, dtype=np.int64),
+									 is_removable, mark_removed, num_to_remove )
+		if self._edge_exists is None:
+			self._removed_edges = removed
+		self._cost_matrix = None
+		self._neighbors = {}
+		self._lower_bound = None
+
+	# Most random picks drawn per block while removing edges
+	REPLAY_BLOCK_SIZE = 1 << 20
+
+	def _pickEdgesToRemove( self, draw_keys, is_removable, mark_removed, num_to_remove ):
+		''' Removes edges (keys src*n+dst) from successive blocks of random picks
+			returned by draw_keys, taking the first occurrence of each removable one,
+			until num_to_remove are gone -- the same edges a pick-at-a-time loop
+			would remove.  Returns how many keys of the last block were used. '''
+		pending = num_to_remove
+		used = 0
+		while pending > 0:
+			keys = draw_keys()
+			candidates = np.flatnonzero( is_removable(keys) )
+			# Sort (key, position) packed into one int64 so that equal keys end up
+			# together with the earliest pick first
+			position_bits = max(len(keys), 1).bit_length()
+			packed = np.sort( (keys[candidates] << position_bits) | candidates )
+			first = np.diff( packed >> position_bits, prepend=-1 ) != 0
+			taken = np.sort( packed[first] & ((1 << position_bits) - 1) )[:pending]
+			mark_removed( keys[taken] )
+			pending -= len(taken)
+			used = int(taken[-1]) + 1 if len(taken) else len(keys)
+		return used
+
+	def _replayRandomEdgePicks( self, is_removable, mark_removed, num_to_remove, block_size ):
+		''' Removes the edges that repeatedly drawing src = random.randint(0,n-1),
+			dst = random.randint(0,n-1) and removing (src,dst) when still removable
+			would, and leaves the random module in the state that loop would.
+
+			random.randint(0,n-1) takes the top k = n.bit_length() bits of the next
+			32-bit Mersenne Twister output, retrying while they are >= n.  NumPy's
+			MT19937 produces the same raw outputs from the same state, so the picks
+			can be generated and filtered a block at a time. '''
+		if num_to_remove <= 0:
+			return
+		ncities = len(self._xs)
+		shift = 32 - ncities.bit_length()
+		generator = _generatorFromRandom()
+
+		block = {'carry': np.empty(0, dtype=np.int64)}	# carry: a src still waiting for its dst
+		def draw_keys():
+			block['state'] = generator.state
+			picks = generator.random_raw( block_size ) >> shift
+			accepted = np.flatnonzero( picks < ncities )
+			values = np.concatenate( (block['carry'], picks[accepted].astype(np.int64)) )
+			# Raw position (within this block) of each pair's dst draw
+			block['pair_ends'] = accepted[0::2] if len(block['carry']) else accepted[1::2]
+			npairs = len(values) // 2
+			block['carry'] = values[2*npairs:]
+			return values[0:2*npairs:2] * ncities + values[1:2*npairs:2]
+
+		used = self._pickEdgesToRemove( draw_keys, is_removable, mark_removed, num_to_remove )
+
+		# Rewind to the start of the last block and redraw just what the loop used
+		generator.state = block['state']
+		generator.random_raw( int(block['pair_ends'][used-1]) + 1 )
+		_syncRandomTo( generator )
+
+
+
+
+class _CostLookup:
+	''' Scenario.costLookup for a sparse scenario: indexing computes the costs
+		through Scenario.edgeCosts.  Local search reads costs one edge at a time,
+		which NumPy makes slow, so single edges are computed in plain Python
+		instead, by the same operations as Scenario._computeCosts. '''
+
+	def __init__( self, scenario ):
+		self._scenario = scenario
+		self._ncities = len(scenario._xs)
+		self.shape = (self._ncities, self._ncities)
+		self._xs = scenario._xs.tolist()
+		self._ys = scenario._ys.tolist()
+		self._elevations = None if scenario._difficulty == 'Easy' else scenario._elevations.tolist()
+		self._removed_edges = scenario._removed_edges
+
+	def __getitem__( self, key ):
+		src, dst = key
+		if not (isinstance( src, (int, np.integer) ) and isinstance( dst, (int, np.integer) )):
+			return self._scenario.edgeCosts( src, dst )
+		if src == dst:
+			return Scenario.INF_COST
+		if self._removed_edges is not None:
+			edge = int(src) * self._ncities + int(dst)
+			if (int(self._removed_edges[edge >> 3]) >> (edge & 7)) & 1:
+				return Scenario.INF_COST
+		xs, ys = self._xs, self._ys
+		cost = math.sqrt( (xs[dst] - xs[src])**2 +
+						  (ys[dst] - ys[src])**2 )
+		if self._elevations is not None:
+			cost = cost + (self._elevations[dst] - self._elevations[src])
+			cost = max( cost, 0.0 )
+		return int( math.ceil(cost * City.MAP_SCALE) )
+
+
+def _nearestOthers( index, m ):
+	''' The m cities nearest each city, nearest first, leaving the city itself
+		out, from a cKDTree or _GridIndex over all the cities. '''
+	ncities = index.n
+	if m == 0:
+		return np.empty( (ncities, 0), dtype=np.intp )
+	_, near = index.query( index.data, k=m+1 )
+	near = near.reshape(ncities, m+1)
+	# Normally a city is its own nearest, but a twin at the same spot may come first
+	is_self = near == np.arange(ncities)[:,None]
+	keep = np.argsort( is_self, axis=1, kind='stable' )[:, :m]
+	return np.take_along_axis( near, keep, axis=1 )
+
+
+def _columnDuals( ncities, src, dst, costs, iterations ):
+	''' Column prices for an assignment bound (see Scenario._rowDuals), from
+		subgradient ascent on the candidate edges src->dst with float costs:
+		every city leaves by its cheapest candidate edge at the current prices,
+		and the price of entering a city goes up when too few enter it and down
+		when too many do.  The step grows while the bound keeps improving and
+		shrinks when it stalls.  Returns the prices of the best bound seen. '''
+	def cheapest( priced ):
+		row_mins = np.full( ncities, np.inf )
+		np.minimum.at( row_mins, src, priced )
+		return row_mins
+
+	# Start from the column minimums left by reducing the rows
+	row_mins = cheapest( costs )
+	col_duals = np.full( ncities, np.inf )
+	np.minimum.at( col_duals, dst, costs - row_mins[src] )
+	col_duals[np.isinf(col_duals)] = 0
+	best, best_duals = -np.inf, col_duals
+	step_scale = 2.0
+	improved = stalled = 0
+	for _ in range(iterations):
+		priced = costs - col_duals[dst]
+		row_mins = cheapest( priced )
+		leaving = np.flatnonzero( priced == row_mins[src] )
+		# The first cheapest edge of each city that has a candidate edge left
+		_, first = np.unique( src[leaving], return_index=True )
+		choice = dst[leaving[first]]
+		value = row_mins[np.isfinite(row_mins)].sum() + col_duals.sum()
+		if value > best:
+			best, best_duals = value, col_duals
+			improved, stalled = improved + 1, 0
+			if improved == 3:
+				step_scale *= 1.5
+				improved = 0
+		else:
+			improved, stalled = 0, stalled + 1
+			if stalled == 3:
+				step_scale /= 2
+				stalled = 0
+		subgradient = 1.0 - np.bincount( choice, minlength=ncities )
+		norm = subgradient @ subgradient
+		if norm == 0:
+			break		# every city entered once: an optimal assignment on these edges
+		# Polyak's step, aiming a little above the best bound so far
+		col_duals = col_duals + step_scale * (0.05 * abs(best) + 1) / norm * subgradient
+	return best_duals
+
+
+def _spanningForest( ncities, src, dst, weights ):
+	''' Which of the undirected edges src-dst make up a minimum spanning forest,
+		by Boruvka's algorithm: every component takes its cheapest edge out,
+		equal weights going to the earlier edge, and the components those join
+		merge, until no edge leaves a component.  Each round is a few NumPy
+		operations over the edges, and there are O(log n) rounds. '''
+	nedges = len(src)
+	order = np.argsort( weights, kind='stable' )
+	ranks = np.empty( nedges, dtype=np.intp )
+	ranks[order] = np.arange(nedges)
+	components = np.arange(ncities)
+	chosen = np.zeros( nedges, dtype=bool )
+	live = np.arange(nedges)
+	while True:
+		src_components, dst_components = components[src[live]], components[dst[live]]
+		crossing = src_components != dst_components
+		live = live[crossing]
+		if not len(live):
+			return chosen
+		cheapest = np.full( ncities, nedges )
+		np.minimum.at( cheapest, src_components[crossing], ranks[live] )
+		np.minimum.at( cheapest, dst_components[crossing], ranks[live] )
+		picked = order[np.unique( cheapest[cheapest < nedges] )]
+		chosen[picked] = True
+		# Label every merged component with its smallest member: spread the
+		# smaller label across each picked edge, then follow labels to labels
+		ends = components[src[picked]], components[dst[picked]]
+		labels = np.arange(ncities)
+		while (labels[ends[0]] != labels[ends[1]]).any():
+			smaller = np.minimum( labels[ends[0]], labels[ends[1]] )
+			for end in ends:
+				np.minimum.at( labels, labels[end], smaller )
+			labels = labels[labels]
+		while (labels[labels] != labels).any():
+			labels = labels[labels]
+		components = labels[components]
+
+
+def _candidateOneTree( ncities, src, dst, costs, penalties ):
+	''' _oneTree restricted to the undirected candidate edges src-dst: a minimum
+		spanning forest of cities 1..n-1 on them plus the two cheapest of them at
+		city 0.  Costs at least as much as _oneTree, and is not a tree when the
+		edges do not connect the cities, but its degrees still steer the
+		penalties.  Returns its cost and every city's degree in it. '''
+	weights = costs + penalties[src] + penalties[dst]
+	inner = (src != 0) & (dst != 0)
+	in_forest = np.flatnonzero(inner)[_spanningForest( ncities, src[inner], dst[inner], weights[inner] )]
+	total = weights[in_forest].sum()
+	degrees = np.bincount( src[in_forest], minlength=ncities )
+	degrees += np.bincount( dst[in_forest], minlength=ncities )
+	at_start = np.flatnonzero(~inner)
+	ends = at_start[np.argsort( weights[at_start], kind='stable' )[:2]]
+	total += weights[ends].sum()
+	degrees[0] = len(ends)
+	degrees[src[ends] + dst[ends]] += 1
+	return total, degrees
+
+
+def _oneTree( ncities, row, penalties ):
+	''' The minimum 1-tree over every edge of a symmetric cost function, each
+		edge costing the penalties of its ends more: a minimum spanning tree of
+		cities 1..n-1 (Prim's algorithm, O(n^2)) plus the two cheapest edges of
+		city 0.  row(city) gives the city's float costs to every city, np.inf for
+		missing edges; it is asked for one row at a time.  Returns the tree's cost
+		and every city's degree in it, or inf and None when the cities are not
+		connected. '''
+	in_tree = np.zeros( ncities, dtype=bool )
+	in_tree[:2] = True
+	degrees = np.zeros( ncities, dtype=np.intp )
+	parents = np.ones( ncities, dtype=np.intp )
+	keys = row(1) + penalties[1] + penalties
+	keys[in_tree] = np.inf
+	total = 0.0
+	for _ in range(ncities - 2):
+		city = int( keys.argmin() )
+		if np.isinf( keys[city] ):
+			return np.inf, None
+		total += keys[city]
+		degrees[city] += 1
+		degrees[parents[city]] += 1
+		in_tree[city] = True
+		keys[city] = np.inf
+		offers = row(city) + penalties[city] + penalties
+		closer = (offers < keys) & ~in_tree
+		keys[closer] = offers[closer]
+		parents[closer] = city
+	ends = row(0)[1:] + penalties[0] + penalties[1:]
+	cheapest = np.argpartition( ends, 1 )[:2]
+	if np.isinf( ends[cheapest] ).any():
+		return np.inf, None
+	total += ends[cheapest].sum()
+	degrees[0] = 2
+	degrees[cheapest + 1] += 1
+	return total, degrees
+
+
+def _oneTreeBound( ncities, src, dst, costs, row, iterations ):
+	''' The Held-Karp lower bound on a tour for a symmetric cost function: the
+		cost of the minimum 1-tree less twice the sum of the city penalties,
+		which subgradient steps raise for cities of degree above two and lower
+		for leaves.  The steps work on the 1-trees of the candidate edges src-dst
+		(with float costs); the step starts at half the average edge cost of the
+		first of them, holds for the first quarter of the iterations and then
+		shrinks geometrically to a hundredth of that.  The bound is then taken
+		for the best penalties with _oneTree over every edge (row as there), as
+		the candidate edges alone would overstate it.  inf when no tour exists. '''
+	# Each undirected edge once
+	low, high = np.minimum(src, dst), np.maximum(src, dst)
+	_, first = np.unique( low * ncities + high, return_index=True )
+	src, dst, costs = low[first], high[first], costs[first]
+
+	penalties = np.zeros( ncities )
+	previous = np.zeros( ncities )
+	best, best_penalties = -np.inf, penalties
+	step = None
+	hold = iterations // 4
+	decay = 0.01 ** (1.0 / max(iterations - hold, 1))
+	for iteration in range(iterations):
+		total, degrees = _candidateOneTree( ncities, src, dst, costs, penalties )
+		value = total - 2 * penalties.sum()
+		if value > best:
+			best, best_penalties = value, penalties
+		subgradient = degrees - 2
+		if not subgradient.any():
+			break		# the 1-tree is a tour
+		if step is None:
+			step = 0.5 * max( abs(value), 1.0 ) / ncities
+		# Blending in the last subgradient damps zigzagging
+		penalties = penalties + step * (0.7 * subgradient + 0.3 * previous)
+		previous = subgradient
+		if iteration >= hold:
+			step *= decay
+	total, _ = _oneTree( ncities, row, best_penalties )
+	return total - 2 * best_penalties.sum()
+
+
+class _GridIndex:
+	''' Exact nearest-neighbor queries over 2-D points from a uniform grid of
+		square cells (about CITIES_PER_CELL points each), for when SciPy's cKDTree
+		is not available.  Provides the n, data and query(points, k) members of
+		cKDTree that Scenario uses. '''
+	CITIES_PER_CELL = 2
+
+	def __init__( self, points ):
+		self.data = np.asarray( points, dtype=np.float64 )
+		self.n = len(self.data)
+		lo = self.data.min(axis=0) if self.n else np.zeros(2)
+		extent = np.maximum( (self.data.max(axis=0) if self.n else np.zeros(2)) - lo, 1e-12 )
+		self._cell = max( math.sqrt(extent[0] * extent[1] * self.CITIES_PER_CELL / max(self.n, 1)),
+						  extent.max() / 4096 )
+		self._lo = lo
+		self._shape = ( np.floor(extent / self._cell).astype(np.int64) + 1 )
+		cells = self._cellOf( self.data )
+		ids = cells[:,1] * self._shape[0] + cells[:,0]
+		self._order = np.argsort( ids, kind='stable' )
+		self._starts = np.searchsorted( ids[self._order], np.arange(self._shape[0] * self._shape[1] + 1) )
+
+	def _cellOf( self, points ):
+		cells = np.floor( (points - self._lo) / self._cell ).astype(np.int64)
+		return np.clip( cells, 0, self._shape - 1 )
+
+	# Points queried together; bounds the (points x candidates) scratch arrays
+	QUERY_BLOCK = 1024
+
+	def query( self, points, k ):
+		''' (distances, indices) of the k points nearest each of points, nearest
+			first, each an (len(points) x k) array. '''
+		points = np.asarray( points, dtype=np.float64 ).reshape(-1, 2)
+		distances = np.empty( (len(points), k) )
+		indices = np.empty( (len(points), k), dtype=np.intp )
+		for start in range(0, len(points), self.QUERY_BLOCK):
+			rows = np.arange(start, min(start + self.QUERY_BLOCK, len(points)))
+			distances[rows], indices[rows] = self._queryBlock( points[rows], k )
+		return distances, indices
+
+	def _queryBlock( self, points, k ):
+		nx, ny = self._shape
+		cells = self._cellOf( points )
+		distances = np.empty( (len(points), k) )
+		indices = np.empty( (len(points), k), dtype=np.intp )
+		# Grow a square of cells around every point, all points at once, until it
+		# holds k points and the k-th nearest is closer than anything outside the
+		# square can be.  Start from a square expected to hold k points.
+		r = max( 0, int(math.ceil( (math.sqrt(k / self.CITIES_PER_CELL) - 1) / 2 )) )
+		pending = np.arange(len(points))
+		while len(pending):
+			cx, cy = cells[pending, 0], cells[pending, 1]
+			x0, x1 = np.maximum(cx - r, 0), np.minimum(cx + r, nx - 1)
+			# One contiguous run of the sorted points per row of cells in the square
+			ys = cy[:,None] + np.arange(-r, r + 1)[None,:]
+			valid = (ys >= 0) & (ys < ny)
+			ys = np.clip( ys, 0, ny - 1 )
+			lo = self._starts[ys * nx + x0[:,None]]
+			hi = np.where( valid, self._starts[ys * nx + x1[:,None] + 1], lo )
+			lengths = (hi - lo).ravel()
+			counts = (hi - lo).sum(axis=1)
+			total = int(lengths.sum())
+			owner = np.repeat( np.arange(len(pending)), counts )
+			run_start = np.repeat( lo.ravel() - (np.cumsum(lengths) - lengths), lengths )
+			found = self._order[ run_start + np.arange(total) ]
+			offsets = self.data[found] - points[pending][owner]
+			dist = np.sqrt( (offsets * offsets).sum(axis=1) )
+
+			# Lay the candidates out one row per point, padded with inf
+			slot = np.arange(total) - np.repeat( np.cumsum(counts) - counts, counts )
+			table = np.full( (len(pending), max(int(counts.max()), k)), np.inf )
+			table[owner, slot] = dist
+			ids = np.zeros( table.shape, dtype=np.intp )
+			ids[owner, slot] = found
+			nearest = np.argsort( table, axis=1, kind='stable' )[:, :k]
+			kth = table[np.arange(len(pending)), nearest[:, -1]]
+			covers_all = (x0 == 0) & (x1 == nx - 1) & (cy - r <= 0) & (cy + r >= ny - 1)
+			done = covers_all | (kth <= r * self._cell)
+			distances[pending[done]] = np.take_along_axis( table[done], nearest[done], axis=1 )
+			indices[pending[done]] = np.take_along_axis( ids[done], nearest[done], axis=1 )
+			pending = pending[~done]
+			r += 1
+		return distances, indices
 
 
 class City:
-	def __init__( self, x, y, elevation=0.0 ):
-		self._x = x
-		self._y = y
-		self._elevation = elevation
-		self._scenario	= None
-		self._index = -1
-		self._name	= None
-
-	def setIndexAndName( self, index, name ):
-		self._index = index
-		self._name = name
+	"""
+	A city is its scenario plus its index; its coordinates and elevation live in
+	the scenario's arrays.
+	"""
+	__slots__ = ( '_scenario', '_index' )
 
-	def setScenario( self, scenario ):
+	def __init__( self, scenario, index ):
 		self._scenario = scenario
+		self._index = index
+
+	@property
+	def _x( self ):
+		return self._scenario._xs[self._index]
+
+	@property
+	def _y( self ):
+		return self._scenario._ys[self._index]
+
+	@property
+	def _elevation( self ):
+		return self._scenario._elevations[self._index]
+
+	@property
+	def _name( self ):
+		return nameForInt( self._index+1 )
 
 	''' <summary>
 		How much does it cost to get from this city to the destination?
@@ -158,24 +1168,16 @@ class City:
 	def costTo( self, other_city ):
 
 		assert( type(other_city) == City )
+		if PROFILER.enabled:
+			PROFILER.count('City.costTo')
 
-		# In hard mode, remove edges; this slows down the calculation...
-		# Use this in all difficulties, it ensures INF for self-edge
-		if not self._scenario._edge_exists[self._index, other_city._index]:
+		# Euclidean distance, plus (for Medium and Hard modes) an asymmetric
+		# elevation cost, ceiled and scaled -- see Scenario._buildCostMatrix.
+		# Missing edges (removed in hard mode, and self-edges) are INF.
+		cost = self._scenario.edgeCosts( self._index, other_city._index )
+		if cost >= Scenario.INF_COST:
 			return np.inf
-
-		# Euclidean Distance
-		cost = math.sqrt( (other_city._x - self._x)**2 +
-						  (other_city._y - self._y)**2 )
-
-		# For Medium and Hard modes, add in an asymmetric cost (in easy mode it is zero).
-		if not self._scenario._difficulty == 'Easy':
-			cost += (other_city._elevation - self._elevation)
-			if cost < 0.0:
-				cost = 0.0					# Shouldn't it cost something to go downhill, no matter how steep??????
-
-
-		return int(math.ceil(cost * self.MAP_SCALE))
+		return int(cost)
 
 
 class CityCluster:
@@ -184,18 +1186,14 @@ class CityCluster:
 	"""
 	def __init__(self, route: list):
 		self.route = route
-		self.avg_x = 0.
-		self.avg_y = 0.
-		self.avg_elev = 0.
-
-		# Optimization: use merged cities' averages
-		for city in route:
-			self.avg_x += city._x
-			self.avg_y += city._y
-			self.avg_elev += city._elevation
-		self.avg_x /= len(route)
-		self.avg_y /= len(route)
-		self.avg_elev /= len(route)
+		# Position of each city in the route, and the route as city indices, so
+		# splice points are found without scanning the route
+		self.positions = {city: i for i, city in enumerate(route)}
+		self.indices = np.array([city._index for city in route], dtype=np.intp)
+		scenario = route[0]._scenario
+		self.avg_x = scenario._xs[self.indices].mean()
+		self.avg_y = scenario._ys[self.indices].mean()
+		self.avg_elev = scenario._elevations[self.indices].mean()
 
 	def _avg_distance_to(self, city, other_node):
 		cost = math.sqrt( (other_node.avg_x - city._x)**2 +
@@ -214,8 +1212,8 @@ class CityCluster:
 		for city_1 in cities:
 			other_cities = sorted(other_node.route.copy(), key=lambda c: city_1.costTo(c))
 			for city_2 in other_cities:
-				city_3 = other_node.route[(other_node.route.index(city_2) - 1) % len(other_node.route)]
-				city_4 = self.route[(self.route.index(city_1) + 1) % len(self.route)]
+				city_3 = other_node.route[(other_node.positions[city_2] - 1) % len(other_node.route)]
+				city_4 = self.route[(self.positions[city_1] + 1) % len(self.route)]
 
 				if city_1.costTo(city_2) < np.inf and city_3.costTo(city_4) < np.inf:
 					return [city_1, city_2]
@@ -228,35 +1226,45 @@ class CityCluster:
 		if path_to_other is None:
 			return None
 
-		new_route = []
-		for city in self.route:
-			new_route.append(city)
-			if city is path_to_other[0]:
-				o_route = other_node.route
-				o_start_idx = o_route.index(path_to_other[1])
-				for i in range(len(o_route)):
-					new_route.append(o_route[(o_start_idx + i) % len(o_route)])
+		# Leave this route after path_to_other[0], go all the way round the other
+		# route starting at path_to_other[1], then carry on with this route
+		i = self.positions[path_to_other[0]] + 1
+		j = other_node.positions[path_to_other[1]]
+		new_route = self.route[:i] + other_node.route[j:] + other_node.route[:j] + self.route[i:]
 
 		return CityCluster(new_route)
 
 	def shortest_path_between_cluster2(self, other_cluster):
-		minCost = np.inf
-		minCity1 = None
-		minCity2 = None
-		for city1 in self.route:
-			for city2 in other_cluster.route:
-				city3 = other_cluster.route[(other_cluster.route.index(city2) - 1) % len(other_cluster.route)]
-				city4 = self.route[(self.route.index(city1) + 1) % len(self.route)]
-				cost = city1.costTo(city2) + city3.costTo(city4) - city1.costTo(city4) - city3.costTo(city2)
-				if cost < minCost:
-					minCost = cost
-					minCity1 = city1
-					minCity2 = city2
-		if minCost < np.inf:
-			return [minCity1, minCity2]
-		else:
-			return None
-		
-
+		# Splicing the other route in between city1 and city4 = next(city1), entering
+		# it at city2 and leaving it from city3 = previous(city2), costs
+		#   cost(city1,city2) + cost(city3,city4) - cost(city1,city4) - cost(city3,city2)
+		# Evaluate that for every (city1, city2) pair at once, a block of city1s at a
+		# time.  Pairs needing a missing edge are never chosen; pairs removing one
+		# are as good as it gets (the cost is -inf), the first of them winning.
+		cost_matrix = self.route[0]._scenario.costLookup()
+		city1s = self.indices
+		city4s = np.roll(self.indices, -1)
+		city2s = other_cluster.indices
+		city3s = np.roll(other_cluster.indices, 1)
+		removed_other = cost_matrix[city3s, city2s]
 
+		minCost = None
+		minPair = None
+		for start in range(0, len(city1s), Scenario.COST_BLOCK_ROWS):
+			rows = slice(start, start + Scenario.COST_BLOCK_ROWS)
+			added_out = cost_matrix[city1s[rows, None], city2s[None, :]]
+			added_back = cost_matrix[city3s[None, :], city4s[rows, None]]
+			removed_own = cost_matrix[city1s[rows], city4s[rows]][:, None]
+			cost = added_out + added_back - removed_own - removed_other[None, :]
+			cost[(removed_own >= Scenario.INF_COST) | (removed_other[None, :] >= Scenario.INF_COST)] = np.iinfo(np.int64).min
+			cost[(added_out >= Scenario.INF_COST) | (added_back >= Scenario.INF_COST)] = np.iinfo(np.int64).max
+			# argmin takes the first of equal pairs in row-major order, like a double loop
+			best = np.unravel_index(cost.argmin(), cost.shape)
+			if cost[best] < np.iinfo(np.int64).max and (minCost is None or cost[best] < minCost):
+				minCost = cost[best]
+				minPair = (start + best[0], best[1])
 
+		if minPair is not None:
+			return [self.route[minPair[0]], other_cluster.route[minPair[1]]]
+		else:
+			return None
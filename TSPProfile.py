@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+'''
+Opt-in profiling for the scenario and solver code: call counts and cumulative
+wall time per named phase (Scenario construction, edge thinning, cost matrix
+builds, TSPSolution costs, City.costTo, each solver and its main loops).
+
+Profiling is off by default, and then an instrumented call costs a flag check.
+Turn it on with PROFILER.enable(); solver entry points then attach what they
+recorded to their results dictionary as results['profile'], and
+PROFILER.snapshot() gives the totals so far.
+
+	@profiled('Scenario.thinEdges')
+	def thinEdges( self, deterministic=False ):
+		...
+
+	with PROFILER.phase('greedy.routes'):
+		...
+	if PROFILER.enabled:
+		PROFILER.count('City.costTo')
+'''
+
+import collections
+import functools
+import time
+
+
+
+class _NoPhase:
+	''' What phase returns while profiling is off: a reusable do-nothing context. '''
+	def __enter__( self ):
+		return self
+
+	def __exit__( self, *exc_info ):
+		return False
+
+_NO_PHASE = _NoPhase()
+
+
+class _Phase:
+	__slots__ = ('_profiler', '_name', '_start')
+
+	def __init__( self, profiler, name ):
+		self._profiler = profiler
+		self._name = name
+
+	def __enter__( self ):
+		self._start = time.perf_counter()
+		return self
+
+	def __exit__( self, *exc_info ):
+		self._profiler.record( self._name, time.perf_counter() - self._start )
+		return False
+
+
+class Profiler:
+	def __init__( self ):
+		self.enabled = False
+		self._calls = collections.Counter()
+		self._times = collections.defaultdict(float)
+
+	def enable( self, enabled=True ):
+		self.enabled = enabled
+
+	def reset( self ):
+		self._calls.clear()
+		self._times.clear()
+
+	def phase( self, name ):
+		''' Context manager that counts one call of name and adds the time spent
+			inside it.  Phases may nest (times are inclusive) but a phase should not
+			nest inside itself, as in a recursive function, or time is counted twice. '''
+		if not self.enabled:
+			return _NO_PHASE
+		return _Phase( self, name )
+
+	def count( self, name, calls=1 ):
+		''' Counts calls of name without timing them, for calls too short or too
+			frequent to time.  Hot paths check enabled before calling this. '''
+		self._calls[name] += calls
+
+	def record( self, name, seconds, calls=1 ):
+		self._calls[name] += calls
+		self._times[name] += seconds
+
+	def snapshot( self ):
+		''' {name: {'calls':int, 'time':seconds or None}} for everything recorded
+			since the last reset.  time is None for names only ever counted. '''
+		return { name:{'calls':calls, 'time':self._times.get(name)} for name, calls in self._calls.items() }
+
+	def since( self, snapshot ):
+		''' What was recorded after snapshot was taken, in the same form. '''
+		diff = {}
+		for name, now in self.snapshot().items():
+			before = snapshot.get( name, {'calls':0, 'time':None} )
+			if now['calls'] == before['calls']:
+				continue
+			time_spent = now['time']
+			if time_spent is not None and before['time'] is not None:
+				time_spent -= before['time']
+			diff[name] = {'calls':now['calls'] - before['calls'], 'time':time_spent}
+		return diff
+
+	def report( self, profile=None ):
+		''' profile (default: the snapshot) as text lines, slowest phases first. '''
+		profile = self.snapshot() if profile is None else profile
+		names = sorted( profile, key=lambda name: -(profile[name]['time'] or 0.0) )
+		lines = []
+		for name in names:
+			spent = profile[name]['time']
+			lines.append( '{:<32} {:>12} calls {:>12}'.format( name, profile[name]['calls'],
+															   '' if spent is None else '{:.6f} s'.format(spent) ) )
+		return lines
+
+
+# The one profiler the scenario and solver code report to
+PROFILER = Profiler()
+
+
+def profiled( name ):
+	''' Decorator making every call of a function a PROFILER phase. '''
+	def decorate( function ):
+		@functools.wraps(function)
+		def run( *args, **kwargs ):
+			if not PROFILER.enabled:
+				return function(*args, **kwargs)
+			with _Phase(PROFILER, name):
+				return function(*args, **kwargs)
+		return run
+	return decorate
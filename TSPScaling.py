@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+'''
+Scaling suite: times scenario generation, TSPSolution cost evaluation and the
+solvers over a range of sizes and every difficulty with fixed seeds, fits the
+empirical complexity exponent of each (the slope of log time against log n),
+and compares timings and tour costs with a stored baseline.
+
+	python3 TSPScaling.py --save-baseline scaling.json
+	python3 TSPScaling.py --baseline scaling.json --threshold 0.25
+
+With --baseline the exit status is 1 when any measurement is slower, or any
+tour costlier, than the baseline by more than the threshold.  Timings only
+compare on the same machine, so the committed scaling_baseline.json (saved
+with --costs-only) holds just the tour costs that do not depend on timing:
+
+	python3 TSPScaling.py --baseline scaling_baseline.json
+
+Before timing anything it also checks the solvers on small scenarios: the
+exact solvers must agree on the optimum, and every tour returned must visit
+each city once, cost what its results say and be no cheaper than the optimum.
+Any failure also makes the exit status 1 (skip the checks with --no-check).
+'''
+
+import argparse
+import json
+import math
+import sys
+import time
+
+import numpy as np
+
+from TSPBenchmark import DIFFICULTIES, newScenario, runOne
+from TSPClasses import *
+from TSPSolver import TSPSolver
+
+
+SIZES = [ 10, 50, 200, 1000, 5000 ]
+SEED = 20
+SOLVERS = [ 'greedy', 'fancy', 'branchAndBound', 'linKernighan', 'simulatedAnnealing',
+			'heldKarp' ]
+BENCHMARKS = [ 'Scenario', 'TSPSolution.cost' ] + SOLVERS
+
+# Largest size each benchmark is run at; Held-Karp refuses anything bigger
+MAX_SIZE = { 'heldKarp':TSPSolver.HELD_KARP_MAX_CITIES }
+
+# Timing differences smaller than this many seconds are never regressions
+TIME_SLACK = 0.005
+
+# Benchmarks whose cost is the same on any machine, as long as they finish in
+# time; the others improve their tour for as long as they are allowed
+PORTABLE_BENCHMARKS = [ 'TSPSolution.cost', 'greedy', 'fancy', 'branchAndBound', 'heldKarp' ]
+
+# Small scenarios the solvers are checked on.  The exact solvers must all find
+# the optimal tour; the others get CHECK_TIME_LIMIT seconds, and those in
+# COMPLETE_SOLVERS must find some tour whenever one exists
+CHECK_SIZES = [ 4, 5, 7, 10 ]
+CHECK_SEEDS = [ 0, 1, 2 ]
+EXACT_SOLVERS = [ 'heldKarp', 'branchAndBound', 'parallelBranchAndBound' ]
+COMPLETE_SOLVERS = EXACT_SOLVERS + [ 'linKernighan', 'simulatedAnnealing' ]
+CHECK_TIME_LIMIT = 0.2
+
+
+def measure( benchmark, size, difficulty, time_allowance, repeats ):
+	''' One row of the suite: the fastest of repeats runs (in seconds) and the
+		tour cost where there is one.  timed_out rows hit time_allowance, so their
+		time says nothing about the algorithm and is left out of the fits. '''
+	row = { 'benchmark':benchmark, 'size':size, 'difficulty':difficulty,
+			'time':None, 'cost':None, 'timed_out':False, 'error':None }
+	times = []
+	try:
+		for _ in range(repeats):
+			if benchmark == 'Scenario':
+				start = time.perf_counter()
+				newScenario( size, SEED, difficulty ).getCostMatrix()
+				times.append( time.perf_counter() - start )
+				continue
+			scenario = newScenario( size, SEED, difficulty )
+			if benchmark == 'TSPSolution.cost':
+				cities = scenario.getCities()
+				start = time.perf_counter()
+				row['cost'] = TSPSolution( cities ).cost
+				times.append( time.perf_counter() - start )
+			else:
+				results, _ = runOne( scenario, benchmark, time_allowance )
+				times.append( results['time'] )
+				row['cost'] = results['cost']
+				row['timed_out'] = results['time'] >= time_allowance
+	except Exception as e:
+		# Recorded rather than raised so one broken case does not hide the rest
+		row['error'] = '{}: {}'.format( type(e).__name__, e )
+		return row
+	row['time'] = min(times)
+	if isinstance( row['cost'], float ) and math.isinf( row['cost'] ):
+		row['cost'] = None
+	return row
+
+
+def checkSolvers( difficulties, time_allowance ):
+	''' One line per failed check on the CHECK_SIZES x CHECK_SEEDS scenarios
+		(see the module docstring), a solver raising an exception among them. '''
+	failures = []
+	solvers = EXACT_SOLVERS + [ name for name in SOLVERS if name not in EXACT_SOLVERS ]
+	for difficulty in difficulties:
+		for size in CHECK_SIZES:
+			for seed in CHECK_SEEDS:
+				scenario = newScenario( size, seed, difficulty )
+				optimum = None
+				for name in solvers:
+					allowance = time_allowance if name in EXACT_SOLVERS else CHECK_TIME_LIMIT
+					case = '{} n={} seed={} {}'.format( name, size, seed, difficulty )
+					try:
+						results, _ = runOne( scenario, name, allowance )
+					except Exception as e:
+						failures.append( '{}: {}: {}'.format(case, type(e).__name__, e) )
+						continue
+					cost, soln = results['cost'], results['soln']
+					if name in EXACT_SOLVERS:
+						if optimum is None:
+							optimum = cost
+						elif cost != optimum:
+							failures.append( '{}: cost {} but {} found {}'.format(case, cost, EXACT_SOLVERS[0], optimum) )
+					if soln is None:
+						if name in COMPLETE_SOLVERS and optimum is not None and not math.isinf( optimum ):
+							failures.append( '{}: no tour, but the optimum is {}'.format(case, optimum) )
+						continue
+					actual = TSPSolution( soln.route ).cost
+					if sorted( city._index for city in soln.route ) != list( range(size) ):
+						failures.append( '{}: tour does not visit every city once'.format(case) )
+					elif actual != cost:
+						failures.append( '{}: results say {} but the tour costs {}'.format(case, cost, actual) )
+					elif name in COMPLETE_SOLVERS and math.isinf( cost ) and not math.isinf( optimum ):
+						failures.append( '{}: tour uses a missing edge, but the optimum is {}'.format(case, optimum) )
+					elif optimum is not None and cost < optimum:
+						failures.append( '{}: cost {} beats the optimum {}'.format(case, cost, optimum) )
+	return failures
+
+
+def runSuite( sizes, difficulties, benchmarks, time_allowance, repeats, progress=None ):
+	rows = []
+	for benchmark in benchmarks:
+		for difficulty in difficulties:
+			for size in sizes:
+				if size > MAX_SIZE.get( benchmark, size ):
+					continue
+				row = measure( benchmark, size, difficulty, time_allowance, repeats )
+				rows.append( row )
+				if progress:
+					progress( row )
+	return rows
+
+
+def scalingExponents( rows ):
+	''' {(benchmark, difficulty): slope of log time against log size}, from the
+		rows that finished in time; needs at least two sizes. '''
+	points = {}
+	for row in rows:
+		if row['time'] and not row['timed_out'] and row['error'] is None:
+			points.setdefault( (row['benchmark'], row['difficulty']), [] ).append( (row['size'], row['time']) )
+	exponents = {}
+	for key, pts in points.items():
+		if len(pts) >= 2:
+			sizes, times = np.log( np.array(pts, dtype=np.float64) ).T
+			exponents[key] = float( np.polyfit(sizes, times, 1)[0] )
+	return exponents
+
+
+def portableRows( rows ):
+	''' The rows of PORTABLE_BENCHMARKS that finished in time, without their
+		timings, for a baseline that holds on any machine. '''
+	return [ dict(row, time=None) for row in rows
+			 if row['benchmark'] in PORTABLE_BENCHMARKS and not row['timed_out'] and row['error'] is None
+			 and row['cost'] is not None ]
+
+
+def compareToBaseline( rows, baseline, threshold ):
+	''' Lines describing every row slower or costlier than its baseline row by
+		more than threshold (a fraction).  Baseline rows without a time are only
+		compared on cost. '''
+	base_rows = { (b['benchmark'], b['size'], b['difficulty']):b for b in baseline['rows'] }
+	regressions = []
+	for row in rows:
+		base = base_rows.get( (row['benchmark'], row['size'], row['difficulty']) )
+		if base is None:
+			continue
+		name = '{} n={} {}'.format( row['benchmark'], row['size'], row['difficulty'] )
+		if row['error'] is not None:
+			if base['error'] is None:
+				regressions.append( '{}: {}'.format(name, row['error']) )
+			continue
+		if base['error'] is not None:
+			continue
+		# A run cut off by its time allowance can only be compared on cost
+		if base['time'] is not None and not row['timed_out'] and not base['timed_out'] and \
+		   row['time'] > base['time'] * (1 + threshold) and row['time'] - base['time'] > TIME_SLACK:
+			regressions.append( '{}: time {:.6f} s vs {:.6f} s'.format(name, row['time'], base['time']) )
+		if base['cost'] is not None and (row['cost'] is None or row['cost'] > base['cost'] * (1 + threshold)):
+			regressions.append( '{}: cost {} vs {}'.format(name, row['cost'], base['cost']) )
+	return regressions
+
+
+def parseArgs( argv ):
+	parser = argparse.ArgumentParser( description='Measure how the TSP code scales and check it against a baseline.' )
+	parser.add_argument( '--sizes', type=int, nargs='+', default=SIZES )
+	parser.add_argument( '--difficulties', nargs='+', default=DIFFICULTIES, choices=DIFFICULTIES )
+	parser.add_argument( '--benchmarks', nargs='+', default=BENCHMARKS, choices=BENCHMARKS )
+	parser.add_argument( '--time-limit', type=float, default=10.0, help='time allowance per solver run, in seconds' )
+	parser.add_argument( '--repeats', type=int, default=3, help='runs per measurement; the fastest counts' )
+	parser.add_argument( '--baseline', help='baseline file to compare against' )
+	parser.add_argument( '--threshold', type=float, default=0.25,
+						 help='allowed slowdown or cost increase over the baseline, as a fraction' )
+	parser.add_argument( '--save-baseline', help='file to write these results to, as a new baseline' )
+	parser.add_argument( '--costs-only', action='store_true',
+						 help='save only the costs that do not depend on timing (see PORTABLE_BENCHMARKS)' )
+	parser.add_argument( '--no-check', action='store_true', help='skip checking the solvers on small scenarios' )
+	return parser.parse_args( argv )
+
+
+def main( argv=None ):
+	args = parseArgs( argv )
+
+	failures = [] if args.no_check else checkSolvers( args.difficulties, args.time_limit )
+	for line in failures:
+		print( 'CHECK FAILED ' + line )
+
+	def progress( row ):
+		status = row['error'] or ('timed out' if row['timed_out'] else '')
+		print( '{benchmark:<18} {size:>6} {difficulty:<21} '.format(**row) +
+			   '{:>12} {:>12} {}'.format( '' if row['time'] is None else '{:.6f}'.format(row['time']),
+										  '' if row['cost'] is None else row['cost'], status ),
+			   file=sys.stderr )
+
+	rows = runSuite( args.sizes, args.difficulties, args.benchmarks, args.time_limit, args.repeats, progress )
+	exponents = scalingExponents( rows )
+	for (benchmark, difficulty), exponent in sorted( exponents.items() ):
+		print( '{:<18} {:<21} time ~ n^{:.2f}'.format(benchmark, difficulty, exponent) )
+
+	if args.save_baseline:
+		with open( args.save_baseline, 'w' ) as out:
+			json.dump( {'time_limit':args.time_limit, 'rows':portableRows(rows) if args.costs_only else rows},
+					   out, indent=1 )
+			out.write( '\n' )
+
+	if args.baseline:
+		with open( args.baseline ) as f:
+			baseline = json.load( f )
+		regressions = compareToBaseline( rows, baseline, args.threshold )
+		for line in regressions:
+			print( 'REGRESSION ' + line )
+		if regressions:
+			return 1
+	return 1 if failures else 0
+
+
+
+if __name__ == '__main__':
+	sys.exit( main() )
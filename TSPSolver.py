@@ -1,30 +1,153 @@
 #!/usr/bin/python3
 
-from which_pyqt import PYQT_VER
-if PYQT_VER == 'PYQT5':
-	from PyQt5.QtCore import QLineF, QPointF
-elif PYQT_VER == 'PYQT4':
-	from PyQt4.QtCore import QLineF, QPointF
-else:
-	raise Exception('Unsupported Version of PyQt: {}'.format(PYQT_VER))
-
-
-
+# No Qt here: the solver runs headless too (see TSPBenchmark.py)
 
 import time
 import numpy as np
 from TSPClasses import *
+from TSPProfile import PROFILER
+import collections
+import functools
 import heapq
 import itertools
+import multiprocessing
+
 
 
+class SolverListener:
+	''' Base class for objects that follow a solve as it runs (see
+		TSPSolver.addListener).  Both methods get a results dictionary with the
+		usual keys, where time is measured from the start of the entry point the
+		caller invoked and cost is the best cost so far.  They are called on the
+		solving thread. '''
+
+	def on_new_bssf( self, results ):
+		''' A better solution, in results['soln'], was found. '''
+		pass
+
+	def on_stats( self, results ):
+		''' Fresh search statistics; results['soln'] is None and fields a
+			solver does not track are None. '''
+		pass
+
+
+def _solverEntryPoint( method ):
+	''' Marks a TSPSolver method as an entry point.  Progress events from it, and
+		from entry points it calls in turn (the BSSF seeding in branchAndBound, say),
+		are timed from the outermost call, and on_new_bssf only fires when that
+		outermost solve improves.  Each call is also a profiler phase, and with
+		profiling on the outermost call's results get results['profile'].  The
+		outermost call's results also get the scenario's lower bound and the tour's
+		optimality gap, as results['bound'] and results['gap'] (see
+		TSPSolver.optimalityGap), when gaps are reported or a target gap is set,
+		and None otherwise; the time taken to compute the bound counts towards
+		results['time']. '''
+	phase_name = 'TSPSolver.' + method.__name__
+	@functools.wraps(method)
+	def solve( self, *args, **kwargs ):
+		if self._solve_start is not None:
+			with PROFILER.phase(phase_name):
+				return method(self, *args, **kwargs)
+		self._solve_start = time.time()
+		self._solve_best = math.inf
+		self._stop_cost = -math.inf
+		want_bound = self._report_gap or self._target_gap is not None
+		bound_time = 0.0
+		if want_bound:
+			# Cached by the scenario, so only the first solve on it pays for this
+			self._scenario.lowerBound()
+			bound_time = time.time() - self._solve_start
+		if self._target_gap is not None:
+			self._stop_cost = self._scenario.lowerBound() * (1 + self._target_gap / 100.0)
+		profile_start = PROFILER.snapshot() if PROFILER.enabled else None
+		try:
+			with PROFILER.phase(phase_name):
+				results = method(self, *args, **kwargs)
+		finally:
+			self._solve_start = None
+		if profile_start is not None:
+			results['profile'] = PROFILER.since(profile_start)
+		results['time'] += bound_time
+		results['bound'], results['gap'] = self.optimalityGap(results['cost']) if want_bound else (None, None)
+		return results
+	return solve
+
 
 class TSPSolver:
 	def __init__( self, gui_view ):
 		self._scenario = None
+		self._listeners = []
+		self._cancelled = False
+		self._solve_start = None
+		self._solve_best = math.inf
+		self._target_gap = None
+		self._report_gap = False
+		self._stop_cost = -math.inf
 
 	def setupWithScenario( self, scenario ):
 		self._scenario = scenario
+		self._cancelled = False
+
+	# Seconds between on_stats events from the longer-running solvers
+	PROGRESS_INTERVAL = 0.25
+
+	def addListener( self, listener ):
+		''' Sends every later solve's progress events to listener, a SolverListener. '''
+		self._listeners.append( listener )
+
+	def removeListener( self, listener ):
+		self._listeners.remove( listener )
+
+	def cancel( self ):
+		''' Asks the running solver to stop as if its time were up; it returns its
+			best solution so far.  Cleared by setupWithScenario. '''
+		self._cancelled = True
+
+	def setTargetGap( self, gap ):
+		''' Makes later solves stop as if their time were up once their best tour
+			is within gap percent of the scenario's lower bound (see optimalityGap);
+			None, the default, lets them use all their time. '''
+		self._target_gap = gap
+
+	def setReportGap( self, report ):
+		''' Makes later solves add the scenario's lower bound and their tour's
+			optimality gap to their results (see optimalityGap).  Off by default, as
+			the bound can take seconds to compute on a large scenario. '''
+		self._report_gap = report
+
+	def optimalityGap( self, cost ):
+		''' (bound, gap) for a tour of the given cost: the scenario's lower bound
+			(see Scenario.lowerBound) and how far above it the cost is, in percent.
+			The optimal tour costs somewhere in between, so a gap of 0 proves a tour
+			optimal.  gap is None when either is infinite or the bound is 0. '''
+		bound = self._scenario.lowerBound()
+		if math.isinf(cost) or math.isinf(bound) or bound <= 0:
+			return bound, None
+		return bound, 100.0 * (cost - bound) / bound
+
+	def _stopRequested( self ):
+		return self._cancelled or self._solve_best <= self._stop_cost
+
+	def _timeLeft( self, start_time, time_allowance ):
+		return not self._stopRequested() and time.time() - start_time < time_allowance
+
+	def _reportProgress( self, cost, soln=None, count=None, max=None, total=None, pruned=None ):
+		''' Sends on_new_bssf if soln beats the best solution of this solve so far,
+			else on_stats. '''
+		if soln is not None:
+			if not soln.cost < self._solve_best:
+				return
+			self._solve_best = soln.cost
+		if not self._listeners:
+			return
+		results = {'cost':soln.cost if soln is not None else min(cost, self._solve_best),
+				   'time':time.time() - self._solve_start, 'count':count, 'soln':soln,
+				   'max':max, 'total':total, 'pruned':pruned}
+		for listener in self._listeners:
+			if soln is not None:
+				listener.on_new_bssf( results )
+			else:
+				listener.on_stats( results )
 
 
 	''' <summary>
@@ -38,7 +161,8 @@ class TSPSolver:
 		algorithm</returns> 
 	'''
 	
-	def defaultRandomTour( self, time_allowance=60.0 ):
+	@_solverEntryPoint
+	def defaultRandomTour( self, time_allowance=60.0, local_search=False ):
 		results = {}
 		cities = self._scenario.getCities()
 		ncities = len(cities)
@@ -46,18 +170,24 @@ class TSPSolver:
 		count = 0
 		bssf = None
 		start_time = time.time()
-		while not foundTour and time.time()-start_time < time_allowance:
-			# create a random permutation
-			perm = np.random.permutation( ncities )
-			route = []
-			# Now build the route using the random permutation
-			for i in range( ncities ):
-				route.append( cities[ perm[i] ] )
-			bssf = TSPSolution(route)
-			count += 1
-			if bssf.cost < np.inf:
+		# Try random permutations a batch at a time, doubling the batch (up to
+		# the memory cap) while none of them is a valid route
+		batch_size = 1
+		max_batch_size = max(1, self.GREEDY_BATCH_ELEMENTS // max(ncities, 1))
+		while not foundTour and self._timeLeft(start_time, time_allowance):
+			# create random permutations, one per row
+			perms = np.random.random( (batch_size, ncities) ).argsort( axis=1 )
+			costs = self._scenario.routeCosts( perms )
+			valid = np.flatnonzero( costs < np.inf )
+			tried = int(valid[0]) if len(valid) else batch_size - 1
+			count += tried + 1
+			# Now build the route using the first valid permutation (or the last one tried)
+			bssf = TSPSolution( [cities[i] for i in perms[tried]] )
+			if len(valid):
 				# Found a valid route
 				foundTour = True
+				self._reportProgress(bssf.cost, bssf, count)
+			batch_size = min(2 * batch_size, max_batch_size)
 		end_time = time.time()
 		results['cost'] = bssf.cost if foundTour else math.inf
 		results['time'] = end_time - start_time
@@ -66,6 +196,8 @@ class TSPSolver:
 		results['max'] = None
 		results['total'] = None
 		results['pruned'] = None
+		if local_search:
+			results = self._localSearchPostPass(results, time_allowance)
 		return results
 
 
@@ -74,6 +206,8 @@ class TSPSolver:
 		the group project (but it is probably a good idea to just do it for the branch-and
 		bound project as a way to get your feet wet).  Note this could be used to find your
 		initial BSSF.
+		starts limits the start cities tried to the first that many (default: all
+		of them, which is O(n^3) overall); one or a few give a tour in O(n^2).
 		</summary>
 		<returns>results dictionary for GUI that contains three ints: cost of best solution, 
 		time spent to find best solution, total number of solutions found, the best
@@ -81,38 +215,37 @@ class TSPSolver:
 		algorithm</returns> 
 	'''
 
-	def greedy( self,time_allowance=60.0 ):
+	@_solverEntryPoint
+	def greedy( self,time_allowance=60.0, local_search=False, starts=None ):
 		results = {}  # T:O(1) S:O(1)
 		cities = self._scenario.getCities()  # T:O(1) S:O(1)
 		ncities = len(cities)  # T:O(1) S:O(1)
 		count = 0  # T:O(1) S:O(1)
 		bssf = None  # T:O(1) S:O(1)
 		start_time = time.time()  # T:O(1) S:O(1)
-		for start_city in cities:  # T:O(n^4) S:O(n)
-			if time.time() - start_time > time_allowance:  # T:O(1) S:O(1)
+		# Start with a single start city so a tour is ready quickly, then double
+		# the batch up to the memory cap for throughput.  A batch still running
+		# when time is up is dropped
+		batch_size = 1  # T:O(1) S:O(1)
+		max_batch_size = max(1, self.GREEDY_BATCH_ELEMENTS // max(ncities, 1))  # T:O(1) S:O(1)
+		last = ncities if starts is None else min(starts, ncities)  # T:O(1) S:O(1)
+		first = 0  # T:O(1) S:O(1)
+		while first < last:  # T:O(n^3) S:O(b*n)
+			if not self._timeLeft(start_time, time_allowance):  # T:O(1) S:O(1)
 				break
-			route = []  # T:O(1) S:O(1)
-			route.append(start_city)  # T:O(1) S:O(1)
-			current_city = start_city  # T:O(1) S:O(1)
-			while len(route) < ncities:  # T:O(n^3) S:O(1)
-				cheapest_neighbor = None  # T:O(1) S:O(1)
-				cheapest_out_cost = np.inf  # T:O(1) S:O(1)
-				for neighbor_city in cities:  # T:O(n^2) S:O(1)
-					if neighbor_city in route or current_city.costTo(neighbor_city) == np.inf:  # T:O(n) S:O(1)
-						continue
-					if current_city.costTo(neighbor_city) < cheapest_out_cost:  # T:O(1) S:O(1)
-						cheapest_out_cost = current_city.costTo(neighbor_city)  # T:O(1) S:O(1)
-						cheapest_neighbor = neighbor_city  # T:O(1) S:O(1)
-				if cheapest_neighbor is None:  # T:O(1) S:O(1)
-					break
-				else:
-					route.append(cheapest_neighbor)  # T:O(1) S:O(1)
-					current_city = cheapest_neighbor  # T:O(1) S:O(1)
-			if len(route) == ncities:  # T:O(1) S:O(1)
-				solution = TSPSolution(route)  # T:O(n) S:O(n)
-				count += 1  # T:O(1) S:O(1)
-				if solution.cost < bssf.cost if bssf is not None else np.inf:  # T:O(1) S:O(1)
-					bssf = solution  # T:O(1) S:O(1)
+			batch = np.arange(first, min(first + batch_size, last))  # T:O(b) S:O(b)
+			with PROFILER.phase('greedy.routes'):  # T:O(1) S:O(1)
+				routes, complete = self._greedyRoutes(batch, start_time + time_allowance)  # T:O(b*n^2) S:O(b*n)
+			if complete.any():  # T:O(b) S:O(1)
+				count += int(complete.sum())  # T:O(b) S:O(1)
+				costs = self._scenario.routeCosts(routes[complete])  # T:O(b*n) S:O(b)
+				best = costs.argmin()  # T:O(b) S:O(1)
+				# Keep the earliest start city on ties, as a city-by-city scan would
+				if bssf is None or costs[best] < bssf.cost:  # T:O(1) S:O(1)
+					bssf = TSPSolution([cities[i] for i in routes[complete][best]], costs[best])  # T:O(n) S:O(n)
+					self._reportProgress(bssf.cost, bssf, count)  # T:O(1) S:O(1)
+			first += len(batch)  # T:O(1) S:O(1)
+			batch_size = min(2 * batch_size, max_batch_size)  # T:O(1) S:O(1)
 
 		end_time = time.time()
 		results['cost'] = bssf.cost if bssf is not None else math.inf
@@ -122,10 +255,49 @@ class TSPSolver:
 		results['max'] = None
 		results['total'] = None
 		results['pruned'] = None
+		if local_search:
+			results = self._localSearchPostPass(results, time_allowance)
 		return results
 	
 	
 	
+	# Cap on (start cities x cities) handled per greedy batch, to bound memory
+	GREEDY_BATCH_ELEMENTS = 1 << 20
+
+	# Start cities greedy tries when it only seeds another solver: a few give a
+	# good enough tour, and trying all of them costs O(n^3)
+	SEED_GREEDY_STARTS = 8
+
+	def _greedyRoutes( self, starts, deadline=math.inf ):
+		''' Runs nearest-neighbor from every city in starts at once.  Returns an
+			(len(starts) x n) array of city indices, one route per row, and a
+			boolean array telling which routes visited every city (the others hit a
+			dead end and hold garbage past that point).  If the deadline passes or a
+			stop is requested before the routes are done, none of them are. '''
+		ncities = len(self._scenario.getCities())
+		nstarts = len(starts)
+		rows = np.arange(nstarts)
+		routes = np.empty((nstarts, ncities), dtype=np.intp)
+		routes[:, 0] = starts
+		visited = np.zeros((nstarts, ncities), dtype=bool)
+		visited[rows, starts] = True
+		complete = np.ones(nstarts, dtype=bool)
+		current = routes[:, 0]
+		for step in range(1, ncities):
+			if time.time() >= deadline or self._stopRequested():
+				complete[:] = False
+				break
+			out_costs = self._scenario.costRows(current)
+			out_costs[visited] = Scenario.INF_COST
+			# argmin returns the lowest index among ties, matching a scan in city order
+			current = out_costs.argmin(axis=1)
+			complete &= out_costs[rows, current] < Scenario.INF_COST
+			routes[:, step] = current
+			visited[rows, current] = True
+		return routes, complete
+
+
+
 	''' <summary>
 		This is the entry point for the branch-and-bound algorithm that you will implement
 		</summary>
@@ -135,8 +307,427 @@ class TSPSolver:
 		max queue size, total number of states created, and number of pruned states.</returns> 
 	'''
 		
-	def branchAndBound( self, time_allowance=60.0 ):
-		pass
+	@_solverEntryPoint
+	def branchAndBound( self, time_allowance=60.0, local_search=False ):
+		results = {}
+		cities = self._scenario.getCities()
+		start_time = time.time()
+
+		# Seed the BSSF with greedy, falling back to a random tour if greedy dead-ends
+		bssf = self.greedy(time_allowance, starts=self.SEED_GREEDY_STARTS)['soln']
+		if bssf is None or bssf.cost == np.inf:
+			bssf = self.defaultRandomTour(time_allowance - (time.time() - start_time))['soln']
+		bssf_cost = bssf.cost if bssf is not None else np.inf
+
+		def report( route, cost, stats ):
+			soln = TSPSolution([cities[i] for i in route]) if route is not None else None
+			self._reportProgress(cost, soln, **stats)
+
+		with PROFILER.phase('branchAndBound.search'):
+			root = _rootState(self._scenario.getCostMatrix())
+			search = _branchAndBoundSearch(root, [(root[0], None, 0)], bssf_cost, start_time + time_allowance,
+										   stop=self._stopRequested, report=report)
+		if search['route'] is not None:
+			bssf = TSPSolution([cities[i] for i in search['route']])
+
+		end_time = time.time()
+		results['cost'] = bssf.cost if bssf is not None else math.inf
+		results['time'] = end_time - start_time
+		results['count'] = search['count']
+		results['soln'] = bssf
+		results['max'] = search['max']
+		results['total'] = search['total']
+		results['pruned'] = search['pruned']
+		if local_search:
+			results = self._localSearchPostPass(results, time_allowance)
+		return results
+
+
+
+	# Open states handed to each worker process when splitting the search tree
+	PARALLEL_STATES_PER_PROCESS = 8
+
+	''' <summary>
+		Branch-and-bound spread over a pool of processes.  The first levels of the
+		search tree are expanded here, and the resulting subtrees are dealt out to the
+		workers, which all prune against a shared BSSF cost.
+		</summary>
+		<returns>results dictionary for GUI, as for branchAndBound.  Counts are summed
+		over the workers, so max is the largest total number of states the workers
+		can have held at once.</returns> 
+	'''
+
+	@_solverEntryPoint
+	def parallelBranchAndBound( self, time_allowance=60.0, processes=None, local_search=False ):
+		results = {}
+		cities = self._scenario.getCities()
+		start_time = time.time()
+		deadline = start_time + time_allowance
+		processes = processes or multiprocessing.cpu_count()
+
+		bssf = self.greedy(time_allowance, starts=self.SEED_GREEDY_STARTS)['soln']
+		if bssf is None or bssf.cost == np.inf:
+			bssf = self.defaultRandomTour(time_allowance - (time.time() - start_time))['soln']
+		bssf_cost = bssf.cost if bssf is not None else np.inf
+
+		# The workers' own phases are recorded in their processes, not here
+		root = _rootState(self._scenario.getCostMatrix())
+		frontier, total, pruned = _splitFrontier(root, bssf_cost, processes * self.PARALLEL_STATES_PER_PROCESS)
+		# Deal states out round-robin in bound order so every worker gets some
+		# of the most promising ones
+		frontier.sort(key=lambda state: state[0])
+		chunks = [frontier[i::processes] for i in range(processes)]
+		chunks = [(root, chunk, deadline) for chunk in chunks if chunk]
+
+		self._reportProgress(bssf_cost, None, 0, len(frontier), total, pruned)
+
+		searches = []
+		if chunks:
+			shared_bssf = multiprocessing.Value('d', float(bssf_cost))
+			shared_stop = multiprocessing.Value('b', False)
+			with multiprocessing.Pool(len(chunks), _initBranchAndBoundWorker, (shared_bssf, shared_stop)) as pool:
+				pending = pool.map_async(_branchAndBoundWorker, chunks)
+				# The workers' tours stay in their processes until they finish, so
+				# progress here is just the shared BSSF cost
+				while not pending.ready():
+					pending.wait(self.PROGRESS_INTERVAL)
+					if self._stopRequested():
+						shared_stop.value = True
+					self._reportProgress(shared_bssf.value)
+				searches = pending.get()
+
+		count = 0
+		max_queue = 0
+		for search, (_, chunk, _) in zip(searches, chunks):
+			if search['route'] is not None and search['cost'] < bssf_cost:
+				bssf_cost = search['cost']
+				bssf = TSPSolution([cities[i] for i in search['route']])
+			count += search['count']
+			max_queue += search['max']
+			# The states a worker starts from were already counted while splitting
+			total += search['total'] - len(chunk)
+			pruned += search['pruned']
+
+		end_time = time.time()
+		results['cost'] = bssf.cost if bssf is not None else math.inf
+		results['time'] = end_time - start_time
+		results['count'] = count
+		results['soln'] = bssf
+		results['max'] = max(max_queue, len(frontier))
+		results['total'] = total
+		results['pruned'] = pruned
+		if local_search:
+			results = self._localSearchPostPass(results, time_allowance)
+		return results
+
+
+
+	# Largest scenario heldKarp takes on: its tables hold 2^(n-1) x (n-1) entries,
+	# some 50 MB at 20 cities, doubling with every city after that
+	HELD_KARP_MAX_CITIES = 20
+
+	''' <summary>
+		Exact solver for small scenarios: Held-Karp dynamic programming over the
+		subsets of cities, an optimal tour in O(2^n n^2) time and O(2^n n) memory
+		whatever the costs.  Works directly on the asymmetric cost matrix, where a
+		missing edge is just too expensive to use.  Scenarios of more than
+		HELD_KARP_MAX_CITIES cities are refused, leaving no solution, as does
+		running out of time.
+		</summary>
+		<returns>results dictionary for GUI with the optimal tour (None if there is
+		no tour at all); total is the number of table entries filled in.</returns> 
+	'''
+
+	@_solverEntryPoint
+	def heldKarp( self, time_allowance=60.0 ):
+		results = {}
+		cities = self._scenario.getCities()
+		start_time = time.time()
+
+		route = None
+		total = 0
+		if len(cities) <= self.HELD_KARP_MAX_CITIES:
+			with PROFILER.phase('heldKarp.layers'):
+				route, total = _heldKarp(self._scenario.getCostMatrix(), start_time + time_allowance,
+										 stop=self._stopRequested)
+		solution = TSPSolution([cities[i] for i in route]) if route is not None else None
+		if solution is not None:
+			self._reportProgress(solution.cost, solution, 1)
+
+		end_time = time.time()
+		results['cost'] = solution.cost if solution is not None else math.inf
+		results['time'] = end_time - start_time
+		results['count'] = 1 if solution is not None else 0
+		results['soln'] = solution
+		results['max'] = None
+		results['total'] = total
+		results['pruned'] = None
+		return results
+
+
+
+	# Nearest (by cost) outgoing and incoming cities considered for local search moves
+	LOCAL_SEARCH_NEIGHBORS = 10
+
+	''' <summary>
+		Improves a tour with 2-opt (segment reversal) and Or-opt (moving a run of up
+		to three cities elsewhere) moves until no move helps or time runs out.
+		Only moves adding an edge to one of a city's nearest neighbors (see
+		Scenario.nearestNeighbors) are tried, and cities whose neighborhood has not
+		changed are skipped (don't-look bits).
+		Costs are asymmetric, so a reversal is priced with the reversed segment's own
+		cost, and missing edges simply make a move too expensive to take.
+		</summary>
+		<returns>results dictionary for GUI with the improved solution; count is the
+		number of improving moves applied.</returns> 
+	'''
+
+	@_solverEntryPoint
+	def localSearch( self, solution, time_allowance=60.0 ):
+		results = {}
+		cities = self._scenario.getCities()
+		cost_matrix = self._scenario.costLookup()
+		start_time = time.time()
+
+		tour = Tour([c._index for c in solution.route], cost_matrix)
+		out_neighbors, in_neighbors = self._candidateLists(self.LOCAL_SEARCH_NEIGHBORS)
+		with PROFILER.phase('localSearch.moves'):
+			moves = _localSearch(tour, cost_matrix, out_neighbors, in_neighbors, start_time + time_allowance,
+								 stop=self._stopRequested, symmetric=self._scenario.isSymmetric())
+		if moves > 0:
+			solution = tour.toSolution(cities)
+			self._reportProgress(solution.cost, solution, moves)
+
+		end_time = time.time()
+		results['cost'] = solution.cost
+		results['time'] = end_time - start_time
+		results['count'] = moves
+		results['soln'] = solution
+		results['max'] = None
+		results['total'] = None
+		results['pruned'] = None
+		return results
+
+	def _candidateLists( self, k ):
+		''' The scenario's nearest-neighbor candidates as lists, for _localSearch. '''
+		out_neighbors, in_neighbors = self._scenario.nearestNeighbors(k)
+		return ([[c for c in row if c >= 0] for row in out_neighbors.tolist()],
+				[[c for c in row if c >= 0] for row in in_neighbors.tolist()])
+
+	def _localSearchPostPass( self, results, time_allowance ):
+		''' Runs localSearch on an entry point's solution with whatever is left of
+			its time allowance, folding the improvement into its results. '''
+		if results['soln'] is None:
+			return results
+		improved = self.localSearch(results['soln'], max(time_allowance - results['time'], 0.0))
+		results['cost'] = improved['cost']
+		results['soln'] = improved['soln']
+		results['time'] += improved['time']
+		return results
+
+
+
+	# Cities in the stretch of tour a kick rearranges
+	KICK_SPAN = 30
+	# Share of the time allowance linKernighan gives greedy for its starting tour
+	KICK_SEED_TIME = 0.1
+	# Scenarios smaller than this are handed to heldKarp by the improvement
+	# heuristics, which have no room for their moves (a kick needs eight cities)
+	# while an exact tour of so few costs next to nothing
+	SMALL_SCENARIO_CITIES = 8
+
+	''' <summary>
+		Chained Lin-Kernighan-style search.  The greedy tour (or, when greedy finds
+		no tour, a nearest-neighbor tour that may use missing edges) is brought to
+		a local optimum with 2-opt, Or-opt and or-3opt moves (see localSearch), then
+		repeatedly kicked -- two adjacent runs of cities in a short stretch of the
+		tour trade places -- and re-optimized around the kick, keeping the result
+		only if it is cheaper.  Kicks never reverse a run, so they suit the
+		asymmetric costs, and missing edges just make a tour too expensive to keep.
+		Scenarios of fewer than SMALL_SCENARIO_CITIES cities are solved exactly by
+		heldKarp instead.
+		</summary>
+		<returns>results dictionary for GUI with the best tour found; count is the
+		number of kicks that improved it and total the number of kicks tried.</returns> 
+	'''
+
+	@_solverEntryPoint
+	def linKernighan( self, time_allowance=60.0 ):
+		results = {}
+		cities = self._scenario.getCities()
+		ncities = len(cities)
+		if ncities < self.SMALL_SCENARIO_CITIES:
+			return self.heldKarp(time_allowance)
+		start_time = time.time()
+		deadline = start_time + time_allowance
+
+		with PROFILER.phase('linKernighan.start'):
+			out_neighbors, in_neighbors = self._candidateLists(self.LOCAL_SEARCH_NEIGHBORS)
+			seed = self.greedy(time_allowance * self.KICK_SEED_TIME, starts=self.SEED_GREEDY_STARTS)['soln']
+			if seed is not None:
+				order = [c._index for c in seed.route]
+			else:
+				order = self._quickStartTour(out_neighbors)
+			cost_matrix = self._scenario.costLookup()
+		tour = Tour(order, cost_matrix)
+		symmetric = self._scenario.isSymmetric()
+		_localSearch(tour, cost_matrix, out_neighbors, in_neighbors, deadline, stop=self._stopRequested, or3opt=True,
+					 symmetric=symmetric)
+		if tour.isValid():
+			self._reportProgress(tour.cost, tour.toSolution(cities))
+
+		count = 0
+		kicks = 0
+		span = min(self.KICK_SPAN, ncities)
+		with PROFILER.phase('linKernighan.kicks'):
+			while self._timeLeft(start_time, time_allowance):
+				best_cost = tour.cost
+				tour.checkpoint()
+				# Cut the stretch starting after position s into runs A, B and the
+				# rest, and swap A with B
+				s = np.random.randint(ncities)
+				first, second = np.sort(np.random.choice(np.arange(1, span - 1), 2, replace=False))
+				a_length, b_length = int(first), int(second - first)
+				touched = [tour.cityAt(s + m) for m in (0, 1, first, first + 1, second, second + 1)]
+				tour.relocate(s + 1, a_length, tour.cityAt(s + second))
+				_localSearch(tour, cost_matrix, out_neighbors, in_neighbors, deadline, stop=self._stopRequested,
+							 cities=touched, or3opt=True, symmetric=symmetric)
+				kicks += 1
+				if tour.cost < best_cost:
+					count += 1
+					if tour.isValid():
+						self._reportProgress(tour.cost, tour.toSolution(cities), count)
+				else:
+					tour.rollback()
+
+		solution = tour.toSolution(cities) if tour.isValid() else None
+		end_time = time.time()
+		results['cost'] = solution.cost if solution is not None else math.inf
+		results['time'] = end_time - start_time
+		results['count'] = count
+		results['soln'] = solution
+		results['max'] = None
+		results['total'] = kicks
+		results['pruned'] = None
+		return results
+
+	def _quickStartTour( self, out_neighbors ):
+		''' A starting tour for improvement heuristics: nearest neighbor from city
+			0, taking the cheapest unvisited candidate neighbor and only scanning the
+			city's whole row of costs once every candidate has been visited.  At a
+			dead end it takes a missing edge, for the improvement to work out. '''
+		ncities = len(self._scenario.getCities())
+		visited = np.zeros(ncities, dtype=bool)
+		route = [0] if ncities else []
+		if ncities:
+			visited[0] = True
+		for _ in range(1, ncities):
+			current = route[-1]
+			for city in out_neighbors[current]:
+				if not visited[city]:
+					break
+			else:
+				costs = self._scenario.costRows([current])[0]
+				costs[visited] = np.iinfo(np.int64).max
+				city = int(costs.argmin())
+			visited[city] = True
+			route.append(city)
+		return route
+
+
+
+	# Share of the time allowance simulatedAnnealing gives greedy for its seed tour
+	ANNEAL_SEED_TIME = 0.1
+	# Default start and end temperatures, as fractions of the seed tour's average
+	# edge cost
+	ANNEAL_START_TEMPERATURE = 0.3
+	ANNEAL_END_TEMPERATURE = 0.002
+
+	# Temperature as a function of the start and end temperatures and the
+	# fraction of the annealing time used so far
+	COOLING_SCHEDULES = {
+		'exponential': lambda start, end, f: start * (end / start) ** f,
+		'linear':      lambda start, end, f: start + (end - start) * f,
+	}
+
+	''' <summary>
+		Simulated annealing from the greedy tour (or, when greedy finds no tour, a
+		nearest-neighbor tour that may use missing edges).  Candidate moves -- a
+		2-opt reversal or an Or-opt relocation of up to three cities, each adding
+		an edge to one of a city's nearest neighbors -- are sampled and priced in
+		NumPy batches against the cost matrix, and the first one passing the
+		Metropolis test is applied.  A missing edge costs Scenario.INF_COST, so
+		moves adding one are never taken and moves dropping one always are.
+		The temperature falls from start_temperature to end_temperature (default:
+		fractions of the seed's average edge cost) following the named cooling
+		schedule, reaching the end temperature as time_allowance runs out.
+		Scenarios of fewer than SMALL_SCENARIO_CITIES cities, too small for the
+		moves, are solved exactly by heldKarp instead.
+		</summary>
+		<returns>results dictionary for GUI with the best tour found; count is the
+		number of times the best tour improved and total the number of moves
+		tried.</returns> 
+	'''
+
+	@_solverEntryPoint
+	def simulatedAnnealing( self, time_allowance=60.0, start_temperature=None, end_temperature=None,
+							cooling='exponential' ):
+		results = {}
+		cities = self._scenario.getCities()
+		ncities = len(cities)
+		if ncities < self.SMALL_SCENARIO_CITIES:
+			return self.heldKarp(time_allowance)
+		start_time = time.time()
+		schedule = self.COOLING_SCHEDULES[cooling]
+
+		seed = self.greedy(time_allowance * self.ANNEAL_SEED_TIME, starts=self.SEED_GREEDY_STARTS)
+		out_neighbors, in_neighbors = self._scenario.nearestNeighbors(self.LOCAL_SEARCH_NEIGHBORS)
+		if seed['soln'] is not None:
+			order = np.array([c._index for c in seed['soln'].route])
+		else:
+			order = np.array(self._quickStartTour(self._candidateLists(self.LOCAL_SEARCH_NEIGHBORS)[0]),
+							 dtype=np.intp)
+		cost_matrix = self._scenario.costLookup()
+
+		edge_costs = cost_matrix[order, np.roll(order, -1)]
+		edge_costs = edge_costs[edge_costs < Scenario.INF_COST]
+		average_edge = float(edge_costs.mean()) if len(edge_costs) else 1.0
+		if start_temperature is None:
+			start_temperature = self.ANNEAL_START_TEMPERATURE * average_edge
+		if end_temperature is None:
+			end_temperature = self.ANNEAL_END_TEMPERATURE * average_edge
+		anneal_start = time.time()
+		anneal_time = max(start_time + time_allowance - anneal_start, 1e-9)
+
+		def temperature( now ):
+			return schedule(start_temperature, end_temperature, min((now - anneal_start) / anneal_time, 1.0))
+
+		def report( best_order, best_cost, improvements, tried ):
+			if best_cost >= Scenario.INF_COST:
+				self._reportProgress(math.inf, count=improvements, total=tried)
+			elif best_order is not None:
+				self._reportProgress(best_cost, TSPSolution([cities[i] for i in best_order], best_cost), improvements)
+			else:
+				self._reportProgress(best_cost, count=improvements, total=tried)
+
+		with PROFILER.phase('simulatedAnnealing.moves'):
+			best_order, best_cost, count, tried = _anneal(order, cost_matrix, out_neighbors, in_neighbors,
+														   start_time + time_allowance, temperature,
+														   stop=self._stopRequested, report=report)
+
+		solution = None
+		if best_cost < Scenario.INF_COST:
+			solution = TSPSolution([cities[i] for i in best_order], best_cost)
+			self._reportProgress(solution.cost, solution, count)
+		end_time = time.time()
+		results['cost'] = solution.cost if solution is not None else math.inf
+		results['time'] = end_time - start_time
+		results['count'] = count
+		results['soln'] = solution
+		results['max'] = None
+		results['total'] = tried
+		results['pruned'] = None
+		return results
 
 
 
@@ -154,7 +745,8 @@ class TSPSolver:
 	def get_y_val(self, city):
 		return city._y
 		
-	def fancy(self, time_allowance=60.0):
+	@_solverEntryPoint
+	def fancy(self, time_allowance=60.0, local_search=False):
 		results = {}
 		cities = self._scenario.getCities().copy()
 
@@ -163,6 +755,7 @@ class TSPSolver:
 		# Divide and Conquer
 		cityClusterSolution = self.dcTsp(cities, "vertical")
 		solution = TSPSolution(cityClusterSolution.route)
+		self._reportProgress(solution.cost, solution)
 		
 		end_time = time.time()
 		results['cost'] = solution.cost if solution is not None else math.inf
@@ -172,15 +765,21 @@ class TSPSolver:
 		results['max'] = None
 		results['total'] = None
 		results['pruned'] = None
+		if local_search:
+			results = self._localSearchPostPass(results, time_allowance)
 		return results
 
 	def dcTsp(self, cities, split_direction):
+		if PROFILER.enabled:
+			PROFILER.count('dcTsp')
 		# base cases
 		if len(cities) < 3:
 			return CityCluster(cities)
 		elif len(cities) == 3:
 			# return subsolution w/ optimal route between 3 cities
-			if TSPSolution(cities).cost < TSPSolution(cities[::-1]).cost:
+			indices = [c._index for c in cities]
+			costs = self._scenario.routeCosts([indices, indices[::-1]])
+			if costs[0] < costs[1]:
 				return CityCluster(cities)
 			else:
 				return CityCluster(cities[::-1])
@@ -198,4 +797,596 @@ class TSPSolver:
 			rightCities = cities[len(cities)//2:len(cities)]
 			leftCityCluster = self.dcTsp(leftCities, new_split_direction)
 			rightCityCluster = self.dcTsp(rightCities, new_split_direction)
-			return leftCityCluster.merge_with(rightCityCluster)
\ No newline at end of file
+			with PROFILER.phase('dcTsp.merge'):
+				return leftCityCluster.merge_with(rightCityCluster)
+
+
+
+# Branch-and-bound internals.  These work on plain NumPy state (no City objects)
+# so that worker processes can run them on parts of the search tree.
+#
+# The search is Little et al.'s: rather than extend a route a city at a time,
+# it decides edge by edge which ones the tour uses, splitting a state on the
+# zero-cost edge of its reduced cost matrix whose exclusion would raise the
+# bound most, into a child that must use it and one that must not.
+#
+# A state is (bound, decisions, nused): the lower bound on any tour consistent
+# with its decisions, those decisions as a chain (i, j, use, parent decisions)
+# back to the root's None, and the number of edges they use.  The root is
+# (bound, matrix), its reduced cost matrix as float32 with np.inf for missing
+# edges.  A state's own matrix is rebuilt from the root's when it is needed, so
+# a queued state takes a few tuples rather than an n x n matrix.
+
+def _reduceCostMatrix( matrix, active_rows, active_cols ):
+	''' Reduces a cost matrix in place so that every active row and column
+		holds a zero.  Rows of cities already left and columns of cities already
+		entered are all-inf and are skipped.  Returns the total amount subtracted,
+		inf when some active row or column has no usable edge left. '''
+	row_mins = matrix.min(axis=1)
+	row_mins[~active_rows] = 0
+	infeasible = np.isinf(row_mins).any()
+	row_mins[np.isinf(row_mins)] = 0
+	matrix -= row_mins[:, None]
+
+	col_mins = matrix.min(axis=0)
+	col_mins[~active_cols] = 0
+	infeasible |= np.isinf(col_mins).any()
+	col_mins[np.isinf(col_mins)] = 0
+	matrix -= col_mins[None, :]
+
+	if infeasible:
+		return np.inf
+	return row_mins.sum(dtype=np.float64) + col_mins.sum(dtype=np.float64)
+
+def _rootState( cost_matrix ):
+	matrix = cost_matrix.astype(np.float32)
+	matrix[cost_matrix >= Scenario.INF_COST] = np.inf
+	active = np.ones(cost_matrix.shape[0], dtype=bool)
+	return _reduceCostMatrix(matrix, active, active), matrix
+
+def _stateMatrix( root, decisions ):
+	''' Rebuilds a state from the root: returns its bound, its reduced matrix
+		and each city's successor (-1 where the decisions leave it open).  Tours
+		pay the root bound plus their edges' costs in the root matrix, so the
+		bound is that for the edges used plus a reduction of what is left, in
+		which the edges excluded, and those closing a path of used edges into a
+		subtour, are inf. '''
+	root_bound, root_matrix = root
+	ncities = root_matrix.shape[0]
+	used = []
+	excluded = []
+	while decisions is not None:
+		i, j, use, decisions = decisions
+		(used if use else excluded).append((i, j))
+
+	matrix = root_matrix.copy()
+	successors = np.full(ncities, -1)
+	predecessors = np.full(ncities, -1)
+	bound = root_bound
+	if used:
+		rows, cols = np.array(used).T
+		bound += root_matrix[rows, cols].sum(dtype=np.float64)
+		matrix[rows, :] = np.inf
+		matrix[:, cols] = np.inf
+		successors[rows] = cols
+		predecessors[cols] = rows
+		for first in np.flatnonzero((predecessors < 0) & (successors >= 0)):
+			last = first
+			while successors[last] >= 0:
+				last = successors[last]
+			matrix[last, first] = np.inf
+	if excluded:
+		rows, cols = np.array(excluded).T
+		matrix[rows, cols] = np.inf
+	bound += _reduceCostMatrix(matrix, successors < 0, predecessors < 0)
+	return bound, matrix, successors
+
+def _finishTour( bound, matrix, successors ):
+	''' Completes a state that leaves at most two edges open with the cheapest
+		way to close it into a tour.  Returns the tour's cost and route from city
+		0, or inf and None if none of the ways is a tour. '''
+	ncities = len(successors)
+	rows = np.flatnonzero(successors < 0)
+	cols = np.setdiff1d(np.arange(ncities), successors)
+	best_cost = np.inf
+	best_route = None
+	for perm in itertools.permutations(cols):
+		cost = bound + matrix[rows, list(perm)].sum(dtype=np.float64)
+		if cost >= best_cost:
+			continue
+		tour = successors.copy()
+		tour[rows] = perm
+		route = [0]
+		while len(route) <= ncities and tour[route[-1]] != 0:
+			route.append(int(tour[route[-1]]))
+		if len(route) == ncities:
+			best_cost = cost
+			best_route = tuple(route)
+	return best_cost, best_route
+
+def _branchingEdge( matrix ):
+	''' The zero-cost edge whose exclusion raises the bound most: by the next
+		smallest entries in its row and column, which are then the least the
+		tour pays to leave its start and enter its end. '''
+	rows, cols = np.nonzero(matrix == 0)
+	row_seconds = np.partition(matrix, 1, axis=1)[:, 1]
+	col_seconds = np.partition(matrix, 1, axis=0)[1, :]
+	best = np.argmax(row_seconds[rows] + col_seconds[cols])
+	return int(rows[best]), int(cols[best])
+
+def _expandState( root, decisions, nused, matrix, deadline=math.inf ):
+	''' Splits a state on its branching edge.  Returns its children, as
+		(bound, decisions, nused, matrix, successors), the one using the edge
+		first; a child is left out if the deadline passes first.  Only children
+		_finishTour can complete keep their matrix, the rest get None. '''
+	ncities = matrix.shape[0]
+	i, j = _branchingEdge(matrix)
+	children = []
+	for use in (True, False):
+		if time.time() >= deadline:
+			break
+		child = (i, j, use, decisions)
+		bound, matrix, successors = _stateMatrix(root, child)
+		if nused + use + 2 < ncities:
+			matrix = None
+		children.append( (bound, child, nused + use, matrix, successors) )
+	return children
+
+def _branchAndBoundSearch( root, frontier, bssf_cost, deadline, shared_bssf=None, stop=None, report=None ):
+	''' Best-first search from the given states, breaking ties on bound in favor
+		of states using more edges so complete tours are reached quickly.  States
+		are pruned both when created and when popped if their bound cannot beat
+		the BSSF.  If shared_bssf (a multiprocessing.Value) is given, the BSSF cost
+		is read from it on every pop and published to it on every improvement, so
+		that searches running in other processes prune against it too.
+		The search also ends early once stop() returns true.  report(route, cost,
+		stats), if given, is called with every improved route and, with route None,
+		every PROGRESS_INTERVAL seconds with the max/total/pruned statistics.
+		Returns the best route found here (None if nothing beat bssf_cost) with its
+		cost (inf if None) and the search statistics. '''
+	ncities = root[1].shape[0]
+	tiebreak = itertools.count()
+	heap = []
+	for bound, decisions, nused in frontier:
+		heapq.heappush(heap, (bound, -nused, next(tiebreak), decisions, nused))
+
+	# bssf_cost is only the pruning threshold: another process can lower it
+	# below anything found here, so the best route's own cost is kept apart
+	best_route = None
+	best_cost = np.inf
+	count = 0
+	max_queue = len(heap)
+	total = len(heap)
+	pruned = 0
+	last_report = time.time()
+	while heap and time.time() < deadline and not (stop and stop()):
+		if report and time.time() - last_report >= TSPSolver.PROGRESS_INTERVAL:
+			report(None, bssf_cost, {'count':count, 'max':max_queue, 'total':total, 'pruned':pruned})
+			last_report = time.time()
+		bound, _, _, decisions, nused = heapq.heappop(heap)
+		if shared_bssf is not None:
+			bssf_cost = min(bssf_cost, shared_bssf.value)
+		if bound >= bssf_cost:
+			pruned += 1
+			continue
+
+		with PROFILER.phase('branchAndBound.expand'):
+			bound, matrix, successors = _stateMatrix(root, decisions)
+			if nused + 2 >= ncities:
+				# Only a starting state can be this close to a tour already
+				children = [(bound, decisions, nused, matrix, successors)]
+			else:
+				children = _expandState(root, decisions, nused, matrix, deadline)
+				total += len(children)
+		for child_bound, child, child_nused, matrix, successors in children:
+			if child_bound < bssf_cost and child_nused + 2 >= ncities:
+				child_bound, route = _finishTour(child_bound, matrix, successors)
+				if child_bound < bssf_cost:
+					bssf_cost = best_cost = child_bound
+					best_route = route
+					count += 1
+					if report:
+						report(best_route, bssf_cost, {'count':count, 'max':max_queue, 'total':total, 'pruned':pruned})
+					if shared_bssf is not None:
+						with shared_bssf.get_lock():
+							if bssf_cost < shared_bssf.value:
+								shared_bssf.value = bssf_cost
+			elif child_bound >= bssf_cost:
+				pruned += 1
+			else:
+				heapq.heappush(heap, (child_bound, -child_nused, next(tiebreak), child, child_nused))
+		max_queue = max(max_queue, len(heap))
+
+	return {'route': best_route, 'cost': best_cost, 'count': count,
+			'max': max_queue, 'total': total, 'pruned': pruned}
+
+def _splitFrontier( root, bssf_cost, nstates ):
+	''' Expands the search tree level by level from the root until there are at
+		least nstates open states (or the next level could hold complete tours),
+		pruning against bssf_cost.  Returns the open states and the number of
+		states created and pruned while splitting. '''
+	ncities = root[1].shape[0]
+	frontier = [(root[0], None, 0)]
+	total = 1
+	pruned = 0
+	while 0 < len(frontier) < nstates and max(nused for _, _, nused in frontier) + 3 < ncities:
+		next_frontier = []
+		for _, decisions, nused in frontier:
+			matrix = _stateMatrix(root, decisions)[1]
+			for child_bound, child, child_nused, _, _ in _expandState(root, decisions, nused, matrix):
+				total += 1
+				if child_bound >= bssf_cost:
+					pruned += 1
+				else:
+					next_frontier.append( (child_bound, child, child_nused) )
+		frontier = next_frontier
+	return frontier, total, pruned
+
+# Set in each worker process by the pool initializer; a synchronized Value
+# cannot be passed through Pool.map
+_shared_bssf = None
+_shared_stop = None
+
+def _initBranchAndBoundWorker( shared_bssf, shared_stop ):
+	global _shared_bssf, _shared_stop
+	_shared_bssf = shared_bssf
+	_shared_stop = shared_stop
+
+def _branchAndBoundWorker( args ):
+	root, frontier, deadline = args
+	return _branchAndBoundSearch(root, frontier, _shared_bssf.value, deadline, _shared_bssf,
+								 stop=lambda: _shared_stop.value)
+
+
+
+# Held-Karp internals
+
+def _heldKarp( cost_matrix, deadline, stop=None ):
+	''' Held-Karp on a cost matrix, with tours starting at city 0 and the other
+		cities as bits 0..m-1 of a subset mask.  best[S, j] is the cost of the
+		cheapest path from city 0 through exactly the cities in S, ending at the
+		city of bit j; subsets are filled in a layer (one subset size) at a time,
+		and each layer one end city at a time, so every step is a single NumPy
+		operation over all subsets of that size.  The tables are int32 unless a
+		path could cost too much for that, and INF (which stands for every cost
+		of Scenario.INF_COST or more) is small enough that INF + INF still fits.
+		Returns the optimal route as a list of city indices (None if time ran out
+		or stop() returned true) and the number of table entries filled in. '''
+	ncities = cost_matrix.shape[0]
+	m = ncities - 1
+	if m < 1:
+		return list(range(ncities)), 0
+
+	finite = cost_matrix[cost_matrix < Scenario.INF_COST]
+	dtype = np.int32 if ncities * int(finite.max(initial=0)) < np.iinfo(np.int32).max // 4 else np.int64
+	INF = np.iinfo(dtype).max // 2
+	C = np.minimum(cost_matrix, INF).astype(dtype)
+	# Costs between the cities of the subset bits, and from and to city 0
+	between = C[1:, 1:]
+	from_start = C[0, 1:]
+	to_start = C[1:, 0]
+
+	nsubsets = 1 << m
+	best = np.full((nsubsets, m), INF, dtype=dtype)
+	# The bit of the city visited before the end city; bits fit in int8
+	previous = np.full((nsubsets, m), -1, dtype=np.int8)
+	bits = np.arange(m)
+	best[1 << bits, bits] = from_start
+
+	subsets = np.arange(nsubsets, dtype=np.int64)
+	sizes = np.zeros(nsubsets, dtype=np.int8)
+	for j in range(m):
+		sizes += ((subsets >> j) & 1).astype(np.int8)
+	order = np.argsort(sizes, kind='stable')
+	layer_starts = np.searchsorted(sizes[order], np.arange(m + 2))
+
+	total = m
+	for size in range(2, m + 1):
+		if time.time() >= deadline or (stop and stop()):
+			return None, total
+		layer = order[layer_starts[size]:layer_starts[size + 1]]
+		for j in range(m):
+			ending = layer[(layer >> j) & 1 == 1]
+			before = ending ^ (1 << j)
+			# best[before, i] is INF for every i not in before, so taking the
+			# minimum over all i only ever picks a city of the subset
+			candidates = best[before] + between[:, j]
+			i = candidates.argmin(axis=1)
+			best[ending, j] = np.minimum(candidates[np.arange(len(ending)), i], INF)
+			previous[ending, j] = i
+			total += len(ending)
+
+	full = nsubsets - 1
+	tour_costs = best[full] + to_start
+	j = int(tour_costs.argmin())
+	if tour_costs[j] >= INF:
+		return None, total
+	route = []
+	subset = full
+	while j >= 0:
+		route.append(j + 1)
+		subset, j = subset ^ (1 << j), int(previous[subset, j])
+	route.append(0)
+	return route[::-1], total
+
+
+
+# Local search internals
+
+def _localSearch( tour, cost_matrix, out_neighbors, in_neighbors, deadline, stop=None, cities=None, or3opt=False,
+				  symmetric=False ):
+	''' First-improvement 2-opt and Or-opt on a Tour, in place, until no move
+		helps, the deadline passes or stop() returns true.  Only the given cities
+		(default: all) are looked at to begin with.  With or3opt, runs of any
+		length are moved too (the 3-opt move that keeps every edge's direction).
+		With symmetric costs, 2-opt reverses whichever side of the tour is shorter.
+		Cities at either end of a missing edge are looked at first, so a tour
+		using one is repaired before the rest of it is polished.
+		Returns the number of moves applied. '''
+	ncities = len(tour)
+	if ncities < 5:
+		return 0
+	C = cost_matrix
+	if cities is None:
+		active = [True] * ncities
+		queue = collections.deque(tour.order())
+		if not tour.isValid():
+			order = np.array(tour.order())
+			following = np.roll(order, -1)
+			missing = C[order, following] >= Scenario.INF_COST
+			queue.extendleft(np.concatenate((order[missing], following[missing])).tolist())
+	else:
+		active = [False] * ncities
+		queue = collections.deque()
+		for c in cities:
+			if not active[c]:
+				active[c] = True
+				queue.append(c)
+	moves = 0
+
+	def on_missing_edge( c ):
+		return C[tour.pred(c), c] >= Scenario.INF_COST or C[c, tour.succ(c)] >= Scenario.INF_COST
+
+	def try_two_opt( a ):
+		i = tour.positionOf(a)
+		succ = tour.succ(a)
+		pred = tour.pred(a)
+		# New edge a->b: reverse the run from a's successor up to b
+		for b in out_neighbors[a]:
+			if C[a, b] >= C[a, succ]:
+				break
+			if b == succ or b == pred:
+				continue
+			s, e = (i + 1) % ncities, tour.positionOf(b)
+			if tour.reversalDelta(s, e) < 0:
+				return s, e
+		# New edge b->a: reverse the run from b's successor up to a
+		for b in in_neighbors[a]:
+			if C[b, a] >= C[pred, a]:
+				break
+			if b == succ or b == pred:
+				continue
+			s, e = (tour.positionOf(b) + 1) % ncities, i
+			if tour.reversalDelta(s, e) < 0:
+				return s, e
+		return None
+
+	def try_or_opt( a ):
+		i = tour.positionOf(a)
+		prev = tour.pred(a)
+		for length in range(1, 4):
+			if length > ncities - 3:
+				break
+			last = tour.cityAt(i + length - 1)
+			after = tour.cityAt(i + length)
+
+			def in_run( c ):
+				return (tour.positionOf(c) - i) % ncities < length
+
+			# Insert the run a..last between x and y, choosing x->a or last->y
+			# to be one of the new edges' cheap neighbors
+			candidates = []
+			for x in in_neighbors[a]:
+				if C[x, a] >= C[prev, a]:
+					break
+				candidates.append(x)
+			for y in out_neighbors[last]:
+				if C[last, y] >= C[last, after]:
+					break
+				candidates.append(tour.pred(y))
+			for x in candidates:
+				if in_run(x) or in_run(tour.succ(x)):
+					continue
+				if tour.relocationDelta(i, length, x) < 0:
+					return length, x
+		return None
+
+	def try_or3opt( a ):
+		# a->succ, c->x, z->y become a->x, c->y, z->succ: the run succ..c moves
+		# between z and y.  Both new edges out of a and c come from the neighbor
+		# lists, and the gain so far must stay positive (as in Lin-Kernighan).
+		i = tour.positionOf(a)
+		succ = tour.succ(a)
+		for x in out_neighbors[a]:
+			gain = C[a, succ] - C[a, x]
+			if gain <= 0:
+				break
+			x_offset = (tour.positionOf(x) - i) % ncities
+			if x_offset < 2:
+				continue
+			c = tour.pred(x)
+			for y in out_neighbors[c]:
+				if gain + C[c, x] - C[c, y] <= 0:
+					break
+				if (tour.positionOf(y) - i) % ncities <= x_offset and y != a:
+					continue
+				z = tour.pred(y)
+				if tour.relocationDelta(i + 1, x_offset - 1, z) < 0:
+					return x_offset - 1, z
+		return None
+
+	steps = 0
+	while queue:
+		steps += 1
+		if steps % 64 == 0 and (time.time() >= deadline or (stop and stop())):
+			break
+		a = queue.popleft()
+		if not active[a]:
+			continue
+		active[a] = False
+
+		move = try_two_opt(a)
+		if move is not None:
+			s, e = move
+			if symmetric and (e - s) % ncities >= ncities // 2:
+				s, e = (e + 1) % ncities, (s - 1) % ncities
+			touched = [tour.cityAt(s - 1), tour.cityAt(s), tour.cityAt(e), tour.cityAt(e + 1)]
+			tour.reverse(s, e)
+		else:
+			move = try_or_opt(a)
+			if move is not None:
+				length, x = move
+				i = tour.positionOf(a)
+			elif or3opt:
+				move = try_or3opt(a)
+				if move is None:
+					continue
+				length, x = move
+				i = tour.positionOf(a) + 1
+			else:
+				continue
+			touched = [tour.cityAt(i - 1), tour.cityAt(i), tour.cityAt(i + length - 1), tour.cityAt(i + length),
+					   x, tour.succ(x)]
+			tour.relocate(i, length, x)
+
+		moves += 1
+		repairing = not tour.isValid()
+		for c in touched:
+			if repairing and on_missing_edge(c):
+				active[c] = True
+				queue.appendleft(c)
+			elif not active[c]:
+				active[c] = True
+				queue.append(c)
+	return moves
+
+
+
+# Simulated annealing internals
+
+def _anneal( order, cost_matrix, out_neighbors, in_neighbors, deadline, temperature, stop=None, report=None,
+			 min_batch=16, max_batch=4096 ):
+	''' Simulated annealing on a tour given as an array of city indices (not
+		modified), until the deadline passes or stop() returns true.  Each round
+		samples a batch of moves on the current tour, prices them all at once and
+		applies the first one that passes the Metropolis test at temperature(now);
+		the moves before it were rejected on that same tour, so this is exactly
+		sequential annealing.  The batch doubles (up to max_batch) while nothing is
+		accepted and shrinks again when moves are taken early in it.
+		out_neighbors and in_neighbors are Scenario.nearestNeighbors arrays.
+		report(best_order, best_cost, improvements, tried), if given, is called at
+		most every PROGRESS_INTERVAL seconds, with best_order None when the best
+		tour has not changed since the last call.
+		Returns the best tour's order and cost, the number of times the best tour
+		improved and the number of moves tried. '''
+	C = cost_matrix
+	ncities = len(order)
+	order = np.array(order, dtype=np.intp)
+	current_cost = int(C[order, np.roll(order, -1)].sum())
+	best_order, best_cost = order.copy(), current_cost
+	if ncities < 8:
+		return best_order, best_cost, 0, 0
+	pos = np.empty(ncities, dtype=np.intp)
+	pos[order] = np.arange(ncities)
+	k = out_neighbors.shape[1]
+
+	def prefix_sums():
+		# Tour edge costs summed forwards and backwards, for pricing reversals
+		following = np.roll(order, -1)
+		forward = np.zeros(ncities + 1, dtype=np.int64)
+		backward = np.zeros(ncities + 1, dtype=np.int64)
+		np.cumsum(C[order, following], out=forward[1:])
+		np.cumsum(C[following, order], out=backward[1:])
+		return forward, backward
+
+	def run_cost( sums, s, e ):
+		# Cost of the edges inside each run of positions s..e, which may wrap
+		return np.where(s <= e, sums[e] - sums[s], sums[ncities] - sums[s] + sums[e])
+
+	forward, backward = prefix_sums()
+	improvements = 0
+	tried = 0
+	batch = min_batch
+	reported = True
+	last_report = time.time()
+	while True:
+		now = time.time()
+		if now >= deadline or (stop and stop()):
+			break
+		if report and now - last_report >= TSPSolver.PROGRESS_INTERVAL:
+			report(None if reported else best_order, best_cost, improvements, tried)
+			reported = True
+			last_report = now
+
+		s = np.random.randint(ncities, size=batch)
+		slot = np.random.randint(k, size=batch)
+		two_opt = np.random.random(batch) < 0.5
+		length = np.random.randint(1, 4, size=batch)
+		before = order[s - 1]
+		first = order[s]
+
+		# 2-opt: new edge before->c, reversing the run from s up to c
+		c = out_neighbors[before, slot]
+		e = pos[c]
+		after_e = order[(e + 1) % ncities]
+		run_length = (e - s) % ncities
+		reversal = (C[before, c] + C[first, after_e] - C[before, first] - C[c, after_e]
+					+ run_cost(backward, s, e) - run_cost(forward, s, e))
+		reversal_ok = (c >= 0) & (run_length >= 1) & (run_length <= ncities - 3)
+
+		# Or-opt: move the run of length cities from s to between x and its
+		# successor, adding the edge x->first
+		last = order[(s + length - 1) % ncities]
+		after = order[(s + length) % ncities]
+		x = in_neighbors[first, slot]
+		y = order[(pos[x] + 1) % ncities]
+		relocation = (C[before, after] + C[x, first] + C[last, y]
+					  - C[before, first] - C[last, after] - C[x, y])
+		relocation_ok = (x >= 0) & ((pos[x] - s) % ncities >= length) & (x != before)
+
+		delta = np.where(two_opt, reversal, relocation)
+		ok = np.where(two_opt, reversal_ok, relocation_ok)
+		# Metropolis: take a move with probability exp(-delta/T), i.e. when
+		# delta < -T log(u); improving moves always pass
+		threshold = -temperature(now) * np.log(1.0 - np.random.random(batch))
+		accepted = np.flatnonzero(ok & (delta < threshold))
+		if not len(accepted):
+			tried += batch
+			batch = min(2 * batch, max_batch)
+			continue
+		i = int(accepted[0])
+		tried += i + 1
+		batch = min(max(2 * (i + 1), min_batch), max_batch)
+
+		p = int(s[i])
+		if two_opt[i]:
+			positions = (p + np.arange(int(run_length[i]) + 1)) % ncities
+			order[positions] = order[positions[::-1]]
+		else:
+			run = (p + np.arange(int(length[i]))) % ncities
+			moving = order[run]
+			rest = np.delete(np.roll(order, -p), np.arange(int(length[i])))
+			at = int(np.flatnonzero(rest == x[i])[0]) + 1
+			order = np.roll(np.concatenate((rest[:at], moving, rest[at:])), p)
+			positions = np.arange(ncities)
+		pos[order[positions]] = positions
+		current_cost += int(delta[i])
+		forward, backward = prefix_sums()
+
+		if current_cost < best_cost:
+			best_cost = current_cost
+			best_order = order.copy()
+			improvements += 1
+			reported = False
+
+	return best_order, best_cost, improvements, tried